@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Urlquick cache benchmarks.
+
+Runs urlquick against a local http server, so results only depend on the machine and the
+cache settings, not on the network. The origin server can be given a fixed latency, body size,
+ETag / 304 support and a Cache-Control max-age, to mimic the sites that add-ons scrape.
+
+Measured scenarios:
+
+* miss: first request for a url, the response is fetched and stored.
+* hit_memory: fresh cache hit served from the in memory cache.
+* hit_db: fresh cache hit loaded from the database.
+* stale_revalidate: stale cache hit, revalidated with the server (a 304 when ETags are enabled).
+* concurrent_miss / concurrent_hit: throughput of :meth:`urlquick.Session.fetch_many`.
+
+The growth of the cache files on disk is recorded after the misses have been stored.
+Results are written as json, so runs of different releases or settings can be compared::
+
+    python benchmarks/urlquick_bench.py --output before.json
+    python benchmarks/urlquick_bench.py --shards 4 --output after.json --compare before.json
+
+Or to compare the cache with and without body compression::
+
+    python benchmarks/urlquick_bench.py --compress-threshold 0 --output uncompressed.json
+    python benchmarks/urlquick_bench.py --compare uncompressed.json
+
+Scenarios and settings that the urlquick being benchmarked does not support, like the memory cache
+or sharding on older releases, are skipped, so the same benchmark can be run against every release.
+"""
+
+# Standard Lib
+import argparse
+import threading
+import platform
+import tempfile
+import sqlite3
+import shutil
+import json
+import time
+import sys
+import os
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    # noinspection PyUnresolvedReferences
+    from SocketServer import ThreadingMixIn
+
+# Benchmark the urlquick from this checkout, not an installed copy
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(_ROOT, "script.module.codequick", "lib"))
+import urlquick  # noqa: E402
+
+RESULTS_FORMAT = 1
+
+# Module settings that can be changed from the command line, mapped to the argument name
+SETTINGS = {"CACHE_SHARDS": "shards", "COMPRESS_CODEC": "codec", "COMPRESS_THRESHOLD": "compress_threshold",
+            "JOURNAL_MODE": "journal_mode"}
+
+
+class OriginServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, size=1024 * 50, etag=True, max_age=None):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), OriginHandler)
+        self.latency = latency
+        self.size = size
+        self.etag = etag
+        self.max_age = max_age
+        self.hits = 0
+        self.not_modified = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):  # type: () -> str
+        return "http://127.0.0.1:%d" % self.server_port
+
+    def body(self, path):  # type: (str) -> bytes
+        """Return a compressible html like body of the configured size, unique to the path."""
+        line = "<p class='item'>{} lorem ipsum dolor sit amet, consectetur adipiscing elit</p>\n".format(path)
+        return (line * (self.size // len(line) + 1))[:self.size].encode("utf8")
+
+    def count(self, not_modified):  # type: (bool) -> None
+        with self._lock:
+            self.hits += 1
+            self.not_modified += not_modified
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, which would otherwise stall keep-alive connections
+    disable_nagle_algorithm = True
+
+    # noinspection PyPep8Naming
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        etag = '"{}"'.format(abs(hash(self.path)))
+        not_modified = server.etag and self.headers.get("If-None-Match") == etag
+        server.count(not_modified)
+
+        body = b"" if not_modified else server.body(self.path)
+        self.send_response(304 if not_modified else 200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if server.etag:
+            self.send_header("ETag", etag)
+        if server.max_age is not None:
+            self.send_header("Cache-Control", "max-age={}".format(server.max_age))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def summarize(timings):  # type: (list) -> dict
+    """Return the latency summary in milliseconds."""
+    timings = sorted(timings)
+    count = len(timings)
+
+    def percentile(value):
+        return round(timings[min(count - 1, int(count * value))] * 1000, 3)
+
+    return {"count": count, "min_ms": percentile(0), "median_ms": percentile(0.5), "p95_ms": percentile(0.95),
+            "max_ms": percentile(1), "mean_ms": round(sum(timings) / count * 1000, 3)}
+
+
+def timed(func, items):  # type: (Callable, list) -> list
+    """Call the function once per item, returning the time each call took."""
+    timings = []
+    for item in items:
+        start = time.time()
+        func(item)
+        timings.append(time.time() - start)
+    return timings
+
+
+def disk_usage(cache_location):  # type: (str) -> dict
+    """Return the bytes used by the cache databases, their journals and the body files."""
+    usage = {"database": 0, "files": 0}
+    for root, _, filenames in os.walk(cache_location):
+        for filename in filenames:
+            size = os.path.getsize(os.path.join(root, filename))
+            usage["files" if root != cache_location else "database"] += size
+    usage["total"] = usage["database"] + usage["files"]
+    return usage
+
+
+def configure(args):  # type: (argparse.Namespace) -> None
+    """Apply the module settings given on the command line, warning about those this urlquick does not have."""
+    for name, option in sorted(SETTINGS.items()):
+        value = getattr(args, option)
+        if value is None:
+            continue
+        elif hasattr(urlquick, name):
+            setattr(urlquick, name, value)
+        else:
+            sys.stderr.write("--{} is not supported by urlquick {}, ignored\n".format(
+                option.replace("_", "-"), urlquick.__version__))
+
+
+def run(args):  # type: (argparse.Namespace) -> dict
+    """Run all scenarios and return the results."""
+    configure(args)
+    server = OriginServer(args.latency / 1000.0, args.size, not args.no_etag, args.server_max_age)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    cache_location = tempfile.mkdtemp(prefix="urlquick-bench-")
+    session = urlquick.Session(cache_location, cache_control=args.cache_control)
+    adapter = session.cache_adapter
+    memory_cache = getattr(adapter, "memory_cache", None)
+    urls = ["{}/item/{}".format(server.url, index) for index in range(args.requests)]
+    results = {}
+
+    def scenario(name, func, items, clear_memory=False):
+        hits = server.hits
+        if clear_memory and memory_cache is not None:
+            def func(item, request=func):
+                memory_cache.clear()
+                request(item)
+
+        results[name] = summarize(timed(func, items))
+        results[name]["origin_requests"] = server.hits - hits
+
+    def throughput(name, items):
+        hits = server.hits
+        start = time.time()
+        session.fetch_many(items, max_workers=args.concurrency)
+        elapsed = time.time() - start
+        results[name] = {"count": len(items), "workers": args.concurrency, "seconds": round(elapsed, 3),
+                         "requests_per_second": round(len(items) / elapsed, 1),
+                         "origin_requests": server.hits - hits}
+
+    try:
+        scenario("miss", session.get, urls)
+        results["cache_size"] = dict(disk_usage(cache_location), entries=len(urls))
+        results["cache_size"]["bytes_per_entry"] = results["cache_size"]["total"] // len(urls)
+        if memory_cache is not None:
+            scenario("hit_memory", session.get, urls)
+        scenario("hit_db", session.get, urls, clear_memory=True)
+
+        not_modified = server.not_modified
+        scenario("stale_revalidate", lambda url: session.get(url, max_age=0), urls, clear_memory=True)
+        results["stale_revalidate"]["not_modified"] = server.not_modified - not_modified
+
+        # Older sessions are not thread safe, so there is nothing to measure concurrently
+        if hasattr(session, "fetch_many"):
+            concurrent_urls = ["{}/concurrent/{}".format(server.url, index) for index in range(args.requests)]
+            throughput("concurrent_miss", concurrent_urls)
+            if memory_cache is not None:
+                memory_cache.clear()
+            throughput("concurrent_hit", concurrent_urls)
+
+        stats = adapter.stats.totals() if hasattr(adapter, "stats") else None
+    finally:
+        session.close()
+        adapter.close()
+        if memory_cache is not None:
+            memory_cache.clear()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_location, ignore_errors=True)
+
+    return {
+        "format": RESULTS_FORMAT,
+        "created": int(time.time()),
+        "environment": {
+            "urlquick": urlquick.__version__,
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "config": {
+            "requests": args.requests,
+            "size": args.size,
+            "latency_ms": args.latency,
+            "etag": not args.no_etag,
+            "server_max_age": args.server_max_age,
+            "cache_control": getattr(session, "cache_control", None),
+            "concurrency": args.concurrency,
+            "shards": getattr(urlquick, "CACHE_SHARDS", 1),
+            "codec": getattr(urlquick, "COMPRESS_CODEC", None),
+            "compress_threshold": getattr(urlquick, "COMPRESS_THRESHOLD", None),
+            "journal_mode": getattr(urlquick, "JOURNAL_MODE", None),
+        },
+        "results": results,
+        "stats": stats,
+    }
+
+
+def compare(old, new):  # type: (dict, dict) -> str
+    """Return a table comparing the results of two runs."""
+    metrics = [("median_ms", False), ("p95_ms", False), ("requests_per_second", True), ("total", False)]
+    lines = ["{:<18} {:<20} {:>12} {:>12} {:>8}".format("scenario", "metric", "old", "new", "change")]
+    for name, result in sorted(new["results"].items()):
+        for metric, higher_is_better in metrics:
+            before = old["results"].get(name, {}).get(metric)
+            after = result.get(metric)
+            if before is None or after is None:
+                continue
+
+            change = (after - before) / float(before) * 100 if before else 0.0
+            better = change > 0 if higher_is_better else change < 0
+            mark = "" if abs(change) < 5 else " +" if better else " -"
+            lines.append("{:<18} {:<20} {:>12} {:>12} {:>7.1f}%{}".format(name, metric, before, after, change, mark))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--requests", type=int, default=200, help="number of urls per scenario (default: 200)")
+    parser.add_argument("--size", type=int, default=1024 * 50, help="response body size in bytes (default: 51200)")
+    parser.add_argument("--latency", type=float, default=0, help="origin latency in milliseconds (default: 0)")
+    parser.add_argument("--no-etag", action="store_true", help="origin does not send ETags, so no 304 responses")
+    parser.add_argument("--server-max-age", type=int, help="send Cache-Control with this max-age")
+    parser.add_argument("--cache-control", choices=sorted(getattr(urlquick, "CACHE_CONTROL_MODES", ())),
+                        help="how the session honors the server cache headers")
+    parser.add_argument("--concurrency", type=int, default=8, help="workers for the concurrent scenarios (default: 8)")
+    parser.add_argument("--shards", type=int, help="number of cache database files (default: {})".format(
+        getattr(urlquick, "CACHE_SHARDS", 1)))
+    parser.add_argument("--codec", choices=sorted(getattr(urlquick, "_CODECS", ())),
+                        help="compression codec for cached bodies (default: {})".format(
+                            getattr(urlquick, "COMPRESS_CODEC", None)))
+    parser.add_argument("--compress-threshold", type=int,
+                        help="compress bodies larger than this size in bytes, 0 to disable (default: {})".format(
+                            getattr(urlquick, "COMPRESS_THRESHOLD", None)))
+    parser.add_argument("--journal-mode", help="sqlite journal mode of the cache databases (default: {})".format(
+        getattr(urlquick, "JOURNAL_MODE", None)))
+    parser.add_argument("--output", help="write the json results to this file, instead of stdout")
+    parser.add_argument("--compare", help="json results of a previous run, to compare against")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    data = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as stream:
+            stream.write(data + "\n")
+    else:
+        print(data)
+
+    if args.compare:
+        with open(args.compare) as stream:
+            print(compare(json.load(stream), results))
+
+
+if __name__ == "__main__":
+    main()
@@ -332,6 +332,20 @@ class Dispatcher(object):
             if redirect:
                 self.run_callback(process_errors, redirect)
 
+        finally:
+            self.close_sessions()
+
+    @staticmethod
+    def close_sessions():
+        """
+        Close the shared urlquick session, if urlquick was used at all.
+        This will also run any deferred urlquick tasks, e.g. revalidation of stale cache.
+        """
+        # urlquick is only imported by the add-on when needed, so there is no need to import it here
+        urlquick = sys.modules.get("urlquick")
+        if urlquick is not None and hasattr(urlquick, "close_session"):
+            urlquick.close_session()
+
     def run_delayed(self, exception=None):
         """Execute all delayed callbacks, if any."""
         if self.registered_delayed:
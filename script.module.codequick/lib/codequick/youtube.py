@@ -4,7 +4,6 @@ from __future__ import absolute_import
 # Standard Library Imports
 import logging
 import sqlite3
-import json
 import os
 
 # Package imports
@@ -145,8 +144,8 @@ class API(object):
 
         :raises RuntimeError: If youtube returns a error response.
         """
-        source = self.req_session.get(url, params=query)
-        response = json.loads(source.content)
+        # Decoded response is cached, so cache hits don't need to decode the json again
+        response = self.req_session.get_json(url, params=query)
         if u"error" not in response:  # pragma: no branch
             return response
         else:  # pragma: no cover
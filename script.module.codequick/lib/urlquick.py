@@ -43,23 +43,73 @@ Code Quality: https://codeclimate.com/github/willforde/urlquick
 __version__ = "2.0.0"
 
 # Standard Lib
+from email.utils import parsedate_tz, mktime_tz
+from collections import OrderedDict
+from contextlib import contextmanager
 from functools import wraps
+from fnmatch import fnmatchcase
 import warnings
 import logging
+import threading
+import tempfile
 import hashlib
+import heapq
+import marshal
+import zlib
+import codecs
+import random
 import sqlite3
+import json
+import mmap
+import time
 import sys
 import os
 
 try:
-    # noinspection PyPep8Naming, PyUnresolvedReferences
-    import cPickle as pickle  # Python 2
+    import queue
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences, PyPep8Naming
+    import Queue as queue  # Python 2
+
+try:
+    from urllib.parse import urlsplit, urlunsplit, parse_qsl, unquote_plus, urlencode
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    from urlparse import urlsplit, urlunsplit, parse_qsl  # Python 2
+    # noinspection PyUnresolvedReferences
+    from urllib import unquote_plus, urlencode  # Python 2
+
+# Faster json decoders are used if available
+try:
+    import orjson as _fast_json
+except ImportError:
+    try:
+        import ujson as _fast_json
+    except ImportError:
+        _fast_json = None
+
+# Codecs used to compress cached bodies, zstd and lz4 are optional
+_CODECS = {"zlib": (zlib.compress, zlib.decompress)}
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    # Compressor objects are not thread safe, so a new one is created for each call
+    _CODECS["zstd"] = (lambda data: zstandard.ZstdCompressor().compress(data),
+                       lambda data: zstandard.ZstdDecompressor().decompress(data))
+try:
+    import lz4.frame
 except ImportError:
-    import pickle  # Works for both python 2 & 3
+    pass
+else:
+    _CODECS["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
 
 # Third Party
 from htmlement import HTMLement
 from requests.structures import CaseInsensitiveDict
+from requests.cookies import RequestsCookieJar, create_cookie
+from requests.compat import cookielib
 from requests import adapters
 from requests import *
 import requests
@@ -105,6 +155,13 @@ REDIRECT_CODES = {
     codes.temporary_redirect,
     codes.permanent_redirect,
 }
+# Server errors where a stale response can be used instead, see Session.stale_if_error
+SERVER_ERROR_CODES = {
+    codes.internal_server_error,
+    codes.bad_gateway,
+    codes.service_unavailable,
+    codes.gateway_timeout,
+}
 
 #: The default location for the cached files
 CACHE_LOCATION = _CACHE_LOCATION
@@ -117,6 +174,102 @@ MAX_AGE = 60 * 60 * 4  # 4 Hours
 #: Expired items will be removed from the database.
 EXPIRES = 60 * 60 * 24 * 7  # 1 week
 
+#: The maximum total size in bytes of the cached responses. When the cache grows over this size,
+#: the least recently used responses are removed. Set to 0 for no limit.
+MAX_CACHE_SIZE = 1024 * 1024 * 100  # 100MB
+
+#: The minimum time in seconds between each cleanup of expired cache items.
+#: Only the first session to open the database after this interval will do the cleanup.
+CLEAN_INTERVAL = 60 * 60 * 24  # 1 day
+
+#: The maximum number of responses kept in the in memory cache, that sits in front of the cache database.
+#: Set to 0 to disable the memory cache.
+MEMORY_CACHE_ENTRIES = 64
+
+#: The maximum total size in bytes of the response bodies kept in the in memory cache.
+MEMORY_CACHE_SIZE = 1024 * 1024 * 8  # 8MB
+
+#: Response bodies larger than this size in bytes are stored in separate files instead of in the database.
+#: Cached bodies stored in files are read using a memory mapped file.
+FILE_CACHE_THRESHOLD = 1024 * 512  # 512KB
+
+#: Bodies stored in the database that are larger than this size in bytes are compressed.
+#: Set to 0 to disable compression.
+COMPRESS_THRESHOLD = 1024 * 2  # 2KB
+
+#: The codec used to compress cached bodies, "zlib" or if installed "zstd" and "lz4".
+#: Defaults to zstd for its compression ratio, then lz4, when installed.
+COMPRESS_CODEC = "zstd" if "zstd" in _CODECS else "lz4" if "lz4" in _CODECS else "zlib"
+
+#: Ways that the client max age can be combined with the freshness lifetime given by the server,
+#: when server cache headers are honored. See :attr:`Session.cache_control`.
+CACHE_CONTROL_MODES = {"server", "upper", "lower"}
+
+#: The size in bytes of the chunks fed to the html parser, when parsing a streamed response.
+PARSE_CHUNK_SIZE = 1024 * 16
+
+#: The default maximum number of concurrent requests made by :meth:`Session.fetch_many`.
+#: The connection pool of the cache adapter keeps enough connections per host for this many workers.
+MAX_WORKERS = 10
+
+#: The default maximum number of concurrent requests made by :meth:`Session.prefetch`.
+PREFETCH_WORKERS = 4
+
+#: The default maximum number of bytes downloaded by each call to :meth:`Session.prefetch`.
+PREFETCH_BYTES = 1024 * 1024 * 5  # 5MB
+
+#: Save the cache statistics to the cache location, when :func:`close_session` is called.
+#: The statistics of each invocation are added to the totals already saved.
+DUMP_STATS = False
+
+#: The upper bounds in milliseconds, of the buckets used for the latency histograms.
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+#: The sqlite journal mode used for the cache database. "WAL" allows readers in other processes to
+#: continue while a write is in progress, and survives crashes without corrupting the database.
+#: Falls back to the sqlite default if WAL is not supported by the filesystem.
+JOURNAL_MODE = "WAL"
+
+#: The time in seconds that sqlite waits on a locked database, before giving up on a query.
+BUSY_TIMEOUT = 1
+
+#: The number of times a query is retried, when the database is still locked after the busy timeout.
+BUSY_RETRIES = 3
+
+#: Time in seconds that deferred tasks wait for :func:`run_deferred` to be called, before they are
+#: run by a background thread instead. Stops tasks from piling up when :func:`close_session` is never called.
+DEFERRED_TIMEOUT = 10
+
+#: The time in seconds that cookies without an expiry date are kept by :class:`PersistentCookieJar`.
+#: These are session cookies, but each add-on invocation is a new session.
+SESSION_COOKIE_EXPIRES = 60 * 60 * 24 * 7  # 1 week
+
+#: The number of sqlite files the cache is split into, by cache key. Each file has its own lock,
+#: so concurrent writers mostly touch different files, and a corrupted file only loses its own share
+#: of the cache. Changing the number of files leaves existing cache items unreachable until they expire.
+CACHE_SHARDS = 1
+
+# The time in seconds between updates of the last access time of a cache item
+_ACCESS_RESOLUTION = 60
+
+# The time in seconds before files without a cache item are removed, as they may still be in the middle of being saved
+_ORPHAN_FILE_AGE = 60 * 60
+
+# The name of the file that the cache statistics are saved to
+_STATS_FILENAME = ".urlquick.stats.json"
+
+# The name of the file that persistent cookies are saved to
+_COOKIES_FILENAME = ".urlquick.cookies.slite3"
+
+# Marker for data that is missing from the cache, or not decoded yet
+_MISSING = object()
+
+# The marshal format can change between python versions, so extracted data is tagged with the version
+_MARSHAL_TAG = "py{}.{}".format(*sys.version_info[:2])
+
+# The version of the database schema, the cache is recreated when this changes
+_SCHEMA_VERSION = 11
+
 # Function components to wrap when overriding requests functions
 WRAPPER_ASSIGNMENTS = ["__doc__"]
 
@@ -149,6 +302,49 @@ class Response(requests.Response):
     def __init__(self):
         super(Response, self).__init__()
         self.from_cache = False
+        self.is_stale = False
+        self._json = _MISSING
+
+        #: The cache key the body of this response is stored under, None if the response is not in the cache.
+        self.urlhash = None
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        chunks = super(Response, self).iter_content(chunk_size, decode_unicode)
+        if isinstance(self.raw, mmap.mmap):
+            return self._close_mapped(chunks)
+        return chunks
+
+    def _close_mapped(self, chunks):
+        """Close the memory mapped body file once it has been read, so the file is not held open."""
+        for chunk in chunks:
+            yield chunk
+        self.raw.close()
+
+    def json(self, **kwargs):
+        """
+        Returns the json-encoded content of a response.
+
+        The decoded value is kept, so the body is only decoded once per response.
+        A faster decoder is used when orjson or ujson is installed.
+        Any keyword arguments are passed to :func:`json.loads`, in which case
+        the standard decoder is used and the value is not kept.
+
+        :raises ValueError: If the response body does not contain valid json.
+        """
+        if kwargs:
+            return super(Response, self).json(**kwargs)
+        elif self._json is _MISSING:
+            self._json = self._decode_json()
+        return self._json
+
+    def _decode_json(self):
+        # The fast decoders only support utf8, so fallback to requests for anything else
+        if _fast_json is not None and (self.encoding or "utf8").lower().replace("-", "") == "utf8":
+            try:
+                return _fast_json.loads(self.content)
+            except ValueError:
+                pass
+        return super(Response, self).json()
 
     def xml(self):
         """
@@ -160,10 +356,15 @@ class Response(requests.Response):
         from xml.etree import ElementTree
         return ElementTree.fromstring(self.content)
 
-    def parse(self, tag=u"", attrs=None):
+    def parse(self, tag=u"", attrs=None, chunk_size=PARSE_CHUNK_SIZE):
         """
         Parse's "HTML" document into a element tree using HTMLement.
 
+        If the request was made with ``stream=True``, and the body has not been read yet,
+        the body is parsed chunk by chunk as it's downloaded. The download stops as soon as
+        the filtered element has been closed, the rest of the body is then discarded and
+        the truncated response is not cached.
+
         .. seealso:: The htmlement documentation can be found at.\n
                      http://python-htmlement.readthedocs.io/en/stable/?badge=stable
 
@@ -173,12 +374,35 @@ class Response(requests.Response):
         :param attrs: [opt] Attributes of 'element', used when searching for required section.
                             Attrs should be a dict of unicode key/value pairs.
 
+        :param int chunk_size: [opt] Size in bytes of the chunks fed to the parser, when streaming.
+
         :return: The root element of the element tree.
         :rtype: xml.etree.ElementTree.Element
         """
         tag = tag.decode() if isinstance(tag, bytes) else tag
         parser = HTMLement(tag, attrs)
-        parser.feed(self.text)
+        if self._content_consumed or self.encoding is None:
+            # Without a known encoding, the full body is needed to guess it
+            parser.feed(self.text)
+            return parser.close()
+
+        try:
+            codec = codecs.lookup(self.encoding)
+        except LookupError:
+            # Unknown charset, fallback to the same default that is used for the text property
+            codec = codecs.lookup("utf8")
+
+        decoder = codec.incrementaldecoder(errors="replace")
+        for chunk in self.iter_content(chunk_size):
+            parser.feed(decoder.decode(chunk))
+            # Older versions of htmlement don't stop at the filtered element, so the full body is parsed
+            if getattr(parser, "_finished", False):
+                # Stop the download, the body will not be cached as it was not fully read
+                logger.debug("Found required element, closing response early")
+                self.close()
+                break
+        else:
+            parser.feed(decoder.decode(b"", True))
         return parser.close()
 
     @classmethod
@@ -187,11 +411,42 @@ class Response(requests.Response):
         self.__dict__.update(response.__dict__)
         return self
 
-    def __conform__(self, protocol):
-        """Convert Response to a sql blob."""
-        if protocol is sqlite3.PrepareProtocol:  # pragma: no branch
-            data = pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
-            return sqlite3.Binary(data)
+    def cached_copy(self, request=None):  # type: (PreparedRequest) -> Response
+        """Return a copy of the loaded response, marked as coming from cache. The body is shared, not copied."""
+        new = self.__class__()
+        new.status_code = self.status_code
+        new.url = self.url
+        new.reason = self.reason
+        new.encoding = self.encoding
+        new.headers = CaseInsensitiveDict(self.headers)
+        new._content = self.content
+        new._content_consumed = True
+        new.request = request
+        new.from_cache = True
+        new.urlhash = self.urlhash
+        return new
+
+    @classmethod
+    def from_record(cls, record, request=None, raw=None):  # type: (sqlite3.Row, PreparedRequest, mmap.mmap) -> Response
+        """
+        Rebuild a response from the separate columns of a cache record.
+        If raw is given, the body will be read from raw, e.g. a memory mapped body file.
+        """
+        self = cls()
+        self.status_code = record["status"]
+        self.url = record["url"]
+        self.reason = record["reason"]
+        self.encoding = record["encoding"]
+        self.headers = CaseInsensitiveDict(json.loads(record["headers"]))
+        if raw is None:
+            self._content = decompress_body(record["codec"], bytes(record["content"]))
+            self._content_consumed = True
+        else:
+            self.raw = raw
+        self.request = request
+        self.from_cache = True
+        self.urlhash = record["key"]
+        return self
 
 
 def to_bytes_string(value):  # type: (...) -> bytes
@@ -199,199 +454,1569 @@ def to_bytes_string(value):  # type: (...) -> bytes
     return value.encode("utf8") if isinstance(value, type(u"")) else value
 
 
+def replace_file(src, dst):  # type: (str, str) -> None
+    """Move a file to the destination, replacing the destination if it exists."""
+    if py2:
+        # os.replace is not available, and rename fails on windows if the destination exists
+        remove_file(dst)
+        os.rename(src, dst)
+    else:
+        os.replace(src, dst)
+
+
+def remove_file(path):  # type: (str) -> None
+    """Remove a file, ignoring errors like the file not existing or still being in use."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def retry_busy(func, *args, **kwargs):
+    """
+    Call func, retrying with an increasing random delay while the database is locked by another process.
+    Gives up after :data:`BUSY_RETRIES <urlquick.BUSY_RETRIES>` retries, re-raising the error.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if attempt >= BUSY_RETRIES or not ("locked" in str(e) or "busy" in str(e)):
+                raise
+            delay = 0.05 * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.debug("Cache database is locked, retrying in %.2f seconds", delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+@contextmanager
+def file_lock(path):  # type: (str) -> Iterator[None]
+    """
+    Hold a lock that is exclusive across processes, for as long as the context is active.
+    A write transaction on a sqlite database is used as the lock, as it works on every platform.
+    """
+    conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+    try:
+        retry_busy(conn.execute, "BEGIN IMMEDIATE")
+        yield
+    finally:
+        conn.close()
+
+
+def shard_paths(cache_location, count):  # type: (str, int) -> list
+    """Return the paths of the cache database files. The first file keeps the name used when not sharded."""
+    names = [".urlquick.slite3"] + [".urlquick.{}.slite3".format(index) for index in range(1, count)]
+    return [os.path.join(cache_location, name) for name in names]
+
+
+def is_corrupted(error):  # type: (sqlite3.DatabaseError) -> bool
+    """Return True if the database error was caused by a corrupted database file."""
+    error = str(error)
+    return "file is encrypted" in error or "not a database" in error or "malformed" in error
+
+
+def compress_body(content, content_type=None):  # type: (bytes, str) -> tuple
+    """
+    Compress a body larger than :data:`COMPRESS_THRESHOLD`, using :data:`COMPRESS_CODEC`.
+
+    :returns: A tuple of the codec name and the compressed body, or None and the original
+              body if the body is too small or did not compress well.
+    """
+    if not COMPRESS_THRESHOLD or len(content) <= COMPRESS_THRESHOLD:
+        return None, content
+
+    # Media is already compressed
+    if content_type and content_type.startswith(("image/", "video/", "audio/")):
+        return None, content
+
+    codec = COMPRESS_CODEC if COMPRESS_CODEC in _CODECS else "zlib"
+    compressed = _CODECS[codec][0](content)
+    if len(compressed) < len(content) * 0.9:
+        return codec, compressed
+    return None, content
+
+
+def decompress_body(codec, data):  # type: (str, bytes) -> bytes
+    """
+    Decompress a cached body using the given codec, a codec of None means the body is not compressed.
+
+    :raises ValueError: If the codec is not available, or the body could not be decompressed.
+    """
+    if not codec:
+        return data
+    elif codec not in _CODECS:
+        raise ValueError("cache codec is not available: {}".format(codec))
+
+    try:
+        return _CODECS[codec][1](data)
+    except Exception as e:
+        raise ValueError("unable to decompress cached body: {}".format(e))
+
+
+def body_size(response):  # type: (Response) -> int
+    """Return the size of a cached response body, without reading a memory mapped body."""
+    if response._content is False and isinstance(response.raw, mmap.mmap):
+        return len(response.raw)
+    return len(response.content or b"")
+
+
+def decode_json(response):  # type: (Response) -> Any
+    """Return the decoded json body of a response, used as an extractor by :meth:`Session.get_json`."""
+    return response.json()
+
+
+def iter_concurrent(func, items, max_workers):  # type: (Callable, list, int) -> Iterator[tuple]
+    """
+    Call func for each item using a bounded pool of worker threads.
+
+    Yields (index, result, error) tuples in the order that the calls complete.
+    If the generator is closed early, the workers will stop picking up new items.
+    """
+    tasks = queue.Queue()
+    results = queue.Queue()
+    stopped = threading.Event()
+    for task in enumerate(items):
+        tasks.put(task)
+
+    def worker():
+        while not stopped.is_set():
+            try:
+                index, item = tasks.get_nowait()
+            except queue.Empty:
+                return
+
+            try:
+                results.put((index, func(item), None))
+            except Exception as e:
+                results.put((index, None, e))
+
+    for _ in range(max(1, min(max_workers, len(items)))):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        for _ in range(len(items)):
+            yield results.get()
+    finally:
+        stopped.set()
+
+
+def parse_http_date(value):  # type: (str) -> float
+    """Return a http date header as a unix timestamp, or None if it's not a valid date."""
+    parsed = parsedate_tz(value) if value else None
+    return mktime_tz(parsed) if parsed else None
+
+
+def parse_cache_control(value):  # type: (str) -> dict
+    """Return the directives of a Cache-Control header, as a dict of lowercase names to arguments."""
+    directives = {}
+    for directive in value.split(",") if value else ():
+        name, _, argument = directive.partition("=")
+        name = name.strip().lower()
+        if name:
+            directives[name] = argument.strip().strip('"')
+    return directives
+
+
+def is_no_store(headers):  # type: (CaseInsensitiveDict) -> bool
+    """Return True if the headers forbid caching of the response."""
+    return "no-store" in parse_cache_control(headers.get("Cache-Control"))
+
+
+def parse_vary(headers):  # type: (CaseInsensitiveDict) -> list
+    """Return the sorted, lowercase names of the request headers listed in the Vary header of a response."""
+    names = {name.strip().lower() for name in headers.get("Vary", "").split(",")}
+    names.discard("")
+    return sorted(names)
+
+
+def server_lifetime(headers, now=None):  # type: (CaseInsensitiveDict, float) -> int
+    """
+    Return the remaining freshness lifetime of a response, as given by the server cache headers.
+    Based on RFC 7234, the lifetime is corrected for the time the response has already spent in upstream caches.
+
+    :returns: Lifetime in seconds, -1 if the response must always be revalidated,
+              or None if the server did not give any freshness information.
+    """
+    now = time.time() if now is None else now
+    directives = parse_cache_control(headers.get("Cache-Control"))
+    date = parse_http_date(headers.get("Date"))
+    lifetime = None
+
+    if "no-cache" in directives:
+        return -1
+
+    for name in ("max-age", "s-maxage"):
+        if name in directives:
+            try:
+                lifetime = int(directives[name])
+            except ValueError:
+                return -1
+            break
+
+    if lifetime is None and "Expires" in headers:
+        # An invalid expires date means the response has already expired
+        expires = parse_http_date(headers["Expires"])
+        lifetime = expires - (now if date is None else date) if expires is not None else -1
+
+    if lifetime is None:
+        return None
+
+    # Correct for the age of the response
+    try:
+        age = int(headers.get("Age", 0))
+    except ValueError:
+        age = 0
+    apparent_age = max(0, now - date) if date is not None else 0
+    return max(int(lifetime - max(age, apparent_age)), -1)
+
+
 def hash_url(req):  # type: (PreparedRequest) -> str
     """Return url as a sha1 encoded hash."""
-    data = to_bytes_string(req.url + req.method)
-    body = to_bytes_string(req.body) if req.body else b''
+    return hash_request(req.url, req.method, req.body)
+
+
+def hash_request(url, method, body=None):  # type: (str, str, bytes) -> str
+    """Return the cache key for the given request parts, as a sha1 encoded hash."""
+    data = to_bytes_string(url + method)
+    body = to_bytes_string(body) if body else b''
     return hashlib.sha1(b''.join((data, body))).hexdigest()
 
 
-class CacheRecord(object):
-    """SQL cache data record."""
+class CacheKey(object):
+    """
+    Normalization rules used to build the cache key of a request, so that requests
+    that only differ in unimportant ways share the same cache entry.
+
+    Parameter names can contain shell style wildcards e.g. "utm_*".
+    Without any rules, the cache key is the same as :func:`hash_url`.
+
+    :param bool sort_query: [opt] Sort the query parameters, so their order does not matter.
+    :param list drop_params: [opt] Names of query parameters to ignore, like cache busters or api keys.
+    :param dict host_aliases: [opt] Mapping of host names to the canonical host name to use in their place.
+    :param bool ignore_body: [opt] Ignore the request body.
+    :param list drop_body_params: [opt] Names of form or json body fields to ignore.
+    :param dict hosts: [opt] Mapping of canonical host names to the :class:`CacheKey` used for that host,
+                       in place of these rules.
+
+    Example::
+
+        >>> session = Session(cache_key=CacheKey(sort_query=True, drop_params=["_", "utm_*"]))
+    """
+
+    def __init__(self, sort_query=False, drop_params=(), host_aliases=None, ignore_body=False,
+                 drop_body_params=(), hosts=None):
+        self.sort_query = sort_query
+        self.drop_params = list(drop_params)
+        self.host_aliases = {host.lower(): alias.lower() for host, alias in (host_aliases or {}).items()}
+        self.ignore_body = ignore_body
+        self.drop_body_params = list(drop_body_params)
+        self.hosts = {host.lower(): rules for host, rules in (hosts or {}).items()}
+
+    def __call__(self, req):  # type: (PreparedRequest) -> str
+        """Return the cache key for the request."""
+        scheme, netloc, path, query, fragment = urlsplit(req.url)
+        host = netloc.lower()
+        host = self.host_aliases.get(host, host)
+        rules = self.hosts.get(host, self)
+
+        if rules.sort_query or rules.drop_params:
+            # Raw parameters are kept as is, so the key only changes when a rule applies
+            params = [param for param in query.split("&") if param and not self._dropped(param, rules.drop_params)]
+            query = "&".join(sorted(params) if rules.sort_query else params)
+
+        url = urlunsplit((scheme, host if netloc.lower() != host else netloc, path, query, fragment))
+        body = None if rules.ignore_body else rules._clean_body(req)
+        return hash_request(url, req.method, body)
+
+    @staticmethod
+    def _dropped(param, patterns):  # type: (str, list) -> bool
+        name = unquote_plus(param.split("=", 1)[0])
+        return any(fnmatchcase(name, pattern) for pattern in patterns)
+
+    def _clean_body(self, req):  # type: (PreparedRequest) -> bytes
+        """Return the request body without the ignored fields."""
+        body = req.body
+        if not (body and self.drop_body_params):
+            return body
+
+        content_type = req.headers.get("Content-Type", "")
+        body = to_bytes_string(body)
+        try:
+            if content_type.startswith("application/x-www-form-urlencoded"):
+                params = parse_qsl(body.decode("utf8"), keep_blank_values=True)
+                params = [(key, value) for key, value in params if not self._dropped(key, self.drop_body_params)]
+                return urlencode(params)
+            elif "json" in content_type:
+                data = json.loads(body.decode("utf8"))
+                if isinstance(data, dict):
+                    data = {key: value for key, value in data.items()
+                            if not self._dropped(key, self.drop_body_params)}
+                    return json.dumps(data, sort_keys=True)
+        except ValueError:
+            # Body could not be decoded, so use as is
+            pass
+        return body
+
+
+class CacheWriter(object):
+    """
+    Wrapper for the raw stream of a response, that saves the decoded body to a file as the caller reads it.
+
+    The response is only cached once the body has been read in full.
+    If the caller stops early or reads the body without decoding it, nothing is cached.
+    """
+
+    def __init__(self, raw, adapter, urlhash, response):  # type: (HTTPResponse, CacheHTTPAdapter, str, Response) -> None
+        self._raw = raw
+        self._adapter = adapter
+        self._urlhash = urlhash
+        self._response = response
+        self._file = None
+        self._path = None
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+    def stream(self, amt=2 ** 16, decode_content=None):
+        if not decode_content:
+            self._abort()
+
+        for chunk in self._raw.stream(amt, decode_content=decode_content):
+            self._write(chunk)
+            yield chunk
+        self._finish()
+
+    def read(self, amt=None, decode_content=None, *args, **kwargs):
+        if not decode_content:
+            self._abort()
+
+        data = self._raw.read(amt, decode_content, *args, **kwargs)
+        self._write(data)
+        if amt is None or not data:
+            self._finish()
+        return data
+
+    def close(self):
+        self._abort()
+        self._raw.close()
+
+    def _write(self, data):  # type: (bytes) -> None
+        if not self._done:
+            if self._file is None:
+                fd, self._path = tempfile.mkstemp(dir=self._adapter.files_dir, prefix=".tmp-")
+                self._file = os.fdopen(fd, "wb")
+            self._file.write(data)
+
+    def _finish(self):
+        """Cache the response, now that the full body has been saved."""
+        if not self._done and self._file is not None:
+            self._file.close()
+            self._done = True
+            logger.debug("Caching streamed %s %s response", self._response.status_code, self._response.reason)
+            self._adapter.set_cache(self._urlhash, self._response, self._path)
+
+    def _abort(self):
+        """Discard the partially saved body."""
+        if not self._done:
+            self._done = True
+            if self._file is not None:
+                self._file.close()
+                remove_file(self._path)
+
+
+class CacheStats(object):
+    """
+    Thread safe counters and latency histograms of cache events, kept per host.
+
+    Counters:
+        * fresh: Responses served from a fresh cache entry.
+        * stale: Stale responses served while revalidating in the background.
+        * stale_error: Stale responses served because the request failed, see :attr:`Session.stale_if_error`.
+        * revalidated: Stale responses that the server confirmed with 304 Not Modified.
+        * miss: Cacheable requests that were sent to the server and not revalidated.
+        * store: Responses saved to the cache.
+        * evict: Cache entries removed to keep the cache under its size limit.
+        * bytes_cached: Bytes of response bodies served from the cache.
+
+    Timings:
+        * lookup: Time taken to check the cache for a request.
+        * network: Time taken for the server to respond with the headers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):  # type: (str) -> dict
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts[host] = {"counters": {}, "timings": {}}
+        return stats
+
+    def count(self, host, name, value=1):  # type: (str, str, int) -> None
+        """Increase the named counter of the given host."""
+        with self._lock:
+            counters = self._host(host)["counters"]
+            counters[name] = counters.get(name, 0) + value
+
+    def timing(self, host, name, seconds):  # type: (str, str, float) -> None
+        """Add a time in seconds to the named latency histogram of the given host."""
+        millis = seconds * 1000
+        bucket = len(LATENCY_BUCKETS)
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if millis <= bound:
+                bucket = index
+                break
+
+        with self._lock:
+            timings = self._host(host)["timings"]
+            timing = timings.get(name)
+            if timing is None:
+                timing = timings[name] = {"count": 0, "total": 0.0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+            timing["count"] += 1
+            timing["total"] += millis
+            timing["buckets"][bucket] += 1
+
+    def snapshot(self):  # type: () -> dict
+        """
+        Return a copy of the statistics, as a dict of host to counters and timings.
+        Timings have a count, the total in milliseconds and the histogram bucket counts,
+        the last bucket counting the times over the largest of :data:`LATENCY_BUCKETS`.
+        """
+        with self._lock:
+            return json.loads(json.dumps(self._hosts))
+
+    def totals(self):  # type: () -> dict
+        """Return the statistics of all hosts combined."""
+        totals = {}
+        merge_stats(totals, {"": stats for stats in self.snapshot().values()})
+        return totals.get("", {"counters": {}, "timings": {}})
+
+    def reset(self):  # type: () -> None
+        """Clear all statistics."""
+        with self._lock:
+            self._hosts.clear()
+
+    def dump(self, path):  # type: (str) -> None
+        """
+        Add the statistics to the totals saved in a json file, then reset the statistics.
+        The file is locked while the totals are updated, so other processes can dump at the same time.
+        """
+        with self._lock:
+            current, self._hosts = self._hosts, {}
+
+        try:
+            with file_lock(path + ".lock"):
+                self._update_file(path, current)
+        except Exception:
+            # Keep the statistics, so they can be saved the next time
+            with self._lock:
+                merge_stats(self._hosts, current)
+            raise
+
+    @staticmethod
+    def _update_file(path, stats):  # type: (str, dict) -> None
+        try:
+            with open(path, "r") as stream:
+                saved = json.load(stream)
+        except (EnvironmentError, ValueError):
+            saved = {}
+
+        merge_stats(saved, stats)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "w") as stream:
+                json.dump(saved, stream)
+            replace_file(tmp_path, path)
+        except EnvironmentError:
+            remove_file(tmp_path)
+            raise
+
+
+def merge_stats(target, source):  # type: (dict, dict) -> None
+    """Add the per host statistics of source to target."""
+    for host, stats in source.items():
+        host_stats = target.setdefault(host, {"counters": {}, "timings": {}})
+        counters = host_stats["counters"]
+        for name, value in stats["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+
+        timings = host_stats["timings"]
+        for name, timing in stats["timings"].items():
+            if name in timings:
+                total = timings[name]
+                total["count"] += timing["count"]
+                total["total"] += timing["total"]
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], timing["buckets"])]
+            else:
+                timings[name] = dict(timing, buckets=list(timing["buckets"]))
+
+
+class MemoryCache(object):
+    """
+    In memory LRU cache of loaded responses, that sits in front of the cache database.
+
+    Bounded by both the number of entries and the total size of the response bodies.
+    Each entry holds the record metadata along with the response.
+    """
+
+    def __init__(self, max_entries=None, max_size=None):  # type: (int, int) -> None
+        self.max_entries = MEMORY_CACHE_ENTRIES if max_entries is None else max_entries
+        self.max_size = MEMORY_CACHE_SIZE if max_size is None else max_size
+        self._entries = OrderedDict()
+        self._vary = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, urlhash):  # type: (str) -> tuple
+        """Return the (metadata, response) entry for the given key, marking it as recently used."""
+        with self._lock:
+            entry = self._entries.pop(urlhash, None)
+            if entry is not None:
+                self._entries[urlhash] = entry
+                return entry[:2]
+
+    def set(self, urlhash, meta, response):  # type: (str, dict, Response) -> None
+        """Add a response to the cache, evicting the least recently used entries if over the limits."""
+        size = len(response.content or b"")
+        with self._lock:
+            self._remove(urlhash)
+            if self.max_entries <= 0 or size > self.max_size:
+                return None
+
+            self._entries[urlhash] = (meta, response, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def update(self, urlhash, **fields):  # type: (str, ...) -> None
+        """Update the metadata of an entry, if it exists. Fields set to None are ignored."""
+        with self._lock:
+            entry = self._entries.get(urlhash)
+            if entry is not None:
+                entry[0].update((name, value) for name, value in fields.items() if value is not None)
+
+    def remove(self, urlhash):  # type: (str) -> None
+        with self._lock:
+            self._remove(urlhash)
+
+    def remove_older(self, cached_date):  # type: (int) -> None
+        """Remove all entries that were cached before the given date."""
+        with self._lock:
+            for urlhash, entry in list(self._entries.items()):
+                if entry[0]["cached_date"] < cached_date:
+                    self._remove(urlhash)
+
+    def get_vary(self, urlhash):  # type: (str) -> list
+        """Return the recorded Vary header names for the given key, or None if not known."""
+        with self._lock:
+            return self._vary.get(urlhash)
+
+    def set_vary(self, urlhash, names):  # type: (str, list) -> None
+        """Record the Vary header names for the given key. More keys are kept than responses, as they are small."""
+        with self._lock:
+            self._vary.pop(urlhash, None)
+            self._vary[urlhash] = names
+            while len(self._vary) > self.max_entries * 16:
+                self._vary.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._vary.clear()
+            self.size = 0
+
+    def _remove(self, urlhash):  # type: (str) -> None
+        entry = self._entries.pop(urlhash, None)
+        if entry is not None:
+            self.size -= entry[2]
 
-    def __init__(self, record):  # type: (sqlite3.Row) -> None
-        self._response = response = pickle.loads(bytes(record["response"]))
-        self._fresh = record["fresh"] or response.status_code in REDIRECT_CODES
-        self._response.from_cache = True
+
+class CacheRecord(object):
+    """
+    SQL cache data record.
+
+    Only the freshness and validators are fetched up front.
+    The response itself is loaded from the database when first accessed.
+    """
+
+    def __init__(self, record, max_age, adapter, request=None, cache_control=None):
+        # type: (sqlite3.Row, int, CacheHTTPAdapter, PreparedRequest, str) -> None
+        self._age = record["age"]
+        self._lifetime = lifetime = self.freshness_lifetime(record["lifetime"], max_age, cache_control)
+        self._fresh = self._age < lifetime or record["status"] in REDIRECT_CODES
+        self._etag = record["etag"]
+        self._last_modified = record["last_modified"]
+        self._key = record["key"]
+        self._adapter = adapter
+        self._request = request
+        self._response = None
 
     @property
     def response(self):  # type: () -> Response
+        """The cached response, or None if the cache item no longer exists."""
+        if self._response is None:
+            self._response = self._adapter.load_response(self._key, self._request)
         return self._response
 
     @property
     def isfresh(self):  # type: () -> bool
-        return self._fresh
+        # A fresh record is of no use if the response has since been removed
+        return self._fresh and self.response is not None
 
-    def add_conditional_headers(self, headers):  # type: (CaseInsensitiveDict) -> None
-        """Return a dict of conditional headers from cache."""
-        # Fetch cached headers
-        cached_headers = self._response.headers
+    @property
+    def age(self):  # type: () -> int
+        """The time in seconds since the response was cached or last revalidated."""
+        return self._age
 
-        # Check for conditional headers
-        if "Etag" in cached_headers:
-            headers["If-none-match"] = cached_headers["ETag"]
-        if "Last-modified" in cached_headers:
-            headers["If-modified-since"] = cached_headers["Last-Modified"]
+    @property
+    def lifetime(self):  # type: () -> int
+        """The time in seconds that the response is considered fresh for."""
+        return self._lifetime
+
+    @staticmethod
+    def freshness_lifetime(server, max_age, cache_control):  # type: (int, int, str) -> int
+        """Combine the lifetime given by the server with the client max age, based on the cache control mode."""
+        if not cache_control or server is None:
+            return max_age
+        elif server < 0:
+            return 0
+        elif cache_control == "upper":
+            return min(server, max_age)
+        elif cache_control == "lower":
+            return max(server, max_age)
+        else:
+            return server
 
+    def add_conditional_headers(self, headers):  # type: (CaseInsensitiveDict) -> None
+        """Return a dict of conditional headers from cache."""
+        if self._etag:
+            headers["If-none-match"] = self._etag
+        if self._last_modified:
+            headers["If-modified-since"] = self._last_modified
 
-class CacheHTTPAdapter(adapters.HTTPAdapter):
-    """Requests adapter that handels https requests and caches them for later use."""
 
-    def __init__(self, cache_location, *args, **kwargs):  # type: (str, ..., ...) -> None
-        super(CacheHTTPAdapter, self).__init__(*args, **kwargs)
-        # sqlite3.enable_callback_tracebacks(True)
-        self._closed = False
+class CacheDatabase(object):
+    """
+    A single sqlite cache database file.
 
-        # Create any missing directorys
-        self.cache_file = os.path.join(cache_location, ".urlquick.slite3")
-        if not os.path.exists(cache_location):
-            os.makedirs(cache_location)
+    Access to the connection is serialized with a lock, so it can be shared between threads.
+    A corrupted database file is removed and recreated, losing only the cache items it contains.
+    """
 
-        # Connect to database
+    def __init__(self, path):  # type: (str) -> None
+        self._lock = threading.RLock()
+        self.path = path
         self.conn = self.connect()
-        self.clean()  # Remove expired
 
-    def connect(self):  # type: () -> sqlite3.Connection
+    def connect(self, repeat=False):  # type: (bool) -> sqlite3.Connection
         """Connect to SQLite Database."""
         try:
-            conn = sqlite3.connect(self.cache_file, timeout=1)
+            # Connection can be shared between threads, access is serialized using the database lock
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
         except sqlite3.Error as e:
             raise CacheError(str(e))
+
+        try:
+            retry_busy(self._setup, conn)
+        except sqlite3.DatabaseError as e:
+            conn.close()
+            if repeat is False and is_corrupted(e):
+                logger.debug("Corrupted database detected, Cleaning: %s", self.path)
+                self._remove_database()
+                return self.connect(repeat=True)
+            raise CacheError(str(e))
         else:
-            conn.row_factory = sqlite3.Row
+            return conn
+
+    def _remove_database(self):  # type: () -> None
+        """Remove the database file, along with the WAL journal files."""
+        for suffix in ("", "-wal", "-shm"):
+            remove_file(self.path + suffix)
+
+    @staticmethod
+    def _setup(conn):  # type: (sqlite3.Connection) -> None
+        """Setup the database tables and journal mode."""
+        # Journal mode must be set outside of a transaction, and is stored in the database file
+        # Changing the mode needs an exclusive lock, so it's only set when not already in use
+        mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        if JOURNAL_MODE.upper() == "WAL":
+            if mode.upper() != "WAL":
+                mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            if mode.upper() == "WAL":
+                # Safe from corruption in WAL mode, only the last commits may be lost on power failure
+                conn.execute("PRAGMA synchronous=NORMAL")
+            else:
+                logger.debug("WAL journal mode is not supported, using %s journal mode", mode)
+        elif mode.upper() != JOURNAL_MODE.upper():
+            conn.execute("PRAGMA journal_mode={}".format(JOURNAL_MODE))
+
+        conn.execute("PRAGMA recursive_triggers=ON")
+
+        # The schema is checked without a lock, so processes that find it up to date never wait on a writer
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == _SCHEMA_VERSION:
+            return None
+        elif version == 0:
+            # Incremental vacuum allows free pages to be released after removing cache items
+            # Only takes effect on a new database, existing databases need to be vacuumed
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+
+        # Take the write lock before changing the schema, so only one process will recreate the tables
+        # Transaction is managed manually, so that the schema changes are not committed implicitly
+        conn.isolation_level = None
+        recreate = False
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # The cache is disposable, so just recreate it if the schema has changed
+            # Checked again, as another process may have changed the schema while waiting on the lock
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 10:
+                # Only the codec marker was added, existing entries are kept as uncompressed bodies
+                conn.execute("ALTER TABLE urlcache ADD COLUMN codec TEXT")
+                conn.execute("PRAGMA user_version={}".format(_SCHEMA_VERSION))
+
+            recreate = version not in (10, _SCHEMA_VERSION)
+            if recreate:
+                conn.execute("DROP TABLE IF EXISTS urlcache")
+                conn.execute("DROP TABLE IF EXISTS urlmeta")
+                conn.execute("DROP TABLE IF EXISTS urlextract")
+                conn.execute("DROP TABLE IF EXISTS urlvary")
+                conn.execute("PRAGMA user_version={}".format(_SCHEMA_VERSION))
+
             conn.execute("""CREATE TABLE IF NOT EXISTS urlcache(
                 key TEXT PRIMARY KEY NOT NULL,
-                response BLOB NOT NULL,
-                cached_date TIMESTAMP NOT NULL
+                status INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                reason TEXT,
+                encoding TEXT,
+                headers TEXT NOT NULL,
+                content BLOB NOT NULL,
+                codec TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                lifetime INTEGER,
+                in_file INTEGER NOT NULL DEFAULT 0,
+                size INTEGER NOT NULL DEFAULT 0,
+                last_access INTEGER NOT NULL DEFAULT 0,
+                cached_date INTEGER NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS urlcache_cached_date ON urlcache(cached_date)")
+            conn.execute("CREATE INDEX IF NOT EXISTS urlcache_last_access ON urlcache(last_access)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS urlmeta(
+                name TEXT PRIMARY KEY NOT NULL,
+                value INTEGER NOT NULL
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS urlvary(
+                key TEXT PRIMARY KEY NOT NULL,
+                headers TEXT NOT NULL,
+                cached_date INTEGER NOT NULL
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS urlextract(
+                key TEXT NOT NULL,
+                name TEXT NOT NULL,
+                data BLOB NOT NULL,
+                PRIMARY KEY (key, name)
             )""")
 
-            # Performance tweak may cause curruption errors
-            # But not an issue as the database will be re-created if so
-            conn.execute("PRAGMA journal_mode=MEMORY")
+            # Extracted data is only valid for the body it was extracted from, so remove it along with
+            # the cache item. Recursive triggers are enabled so this also fires when a row is replaced
+            conn.execute("""CREATE TRIGGER IF NOT EXISTS urlcache_delete AFTER DELETE ON urlcache BEGIN
+                DELETE FROM urlextract WHERE key = old.key;
+            END""")
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            # There is nothing to roll back if the transaction could not be started, e.g. the database is locked
+            # The original error is kept either way, so a locked database can be retried
+            try:
+                if getattr(conn, "in_transaction", True):
+                    conn.execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            raise e
+        finally:
+            conn.isolation_level = ""
 
-        return conn
+        if recreate and conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("VACUUM")
 
     def execute(self, query, values=(), repeat=False):  # type: (str, tuple, bool) -> sqlite3.Cursor
-        """Execute SQL Query."""
+        """Execute SQL Query, retrying if the database is locked by another process."""
         try:
-            with self.conn:
-                # Automatically commits or rolls back on exception
-                return self.conn.execute(query, values)
-        except (sqlite3.IntegrityError, sqlite3.OperationalError) as e:
-            # Check if database is currupted
-            if repeat is False and (str(e).find("file is encrypted") > -1 or str(e).find("not a database") > -1):
-                logger.debug("Corrupted database detected, Cleaning...")
-                self.conn.cursor().close()
-                self.conn.close()
-                os.remove(self.cache_file)
-                self.conn = self.connect()
+            with self._lock:
+                return retry_busy(self._execute, query, values)
+        except sqlite3.DatabaseError as e:
+            # Check if database is currupted, a locked database is never removed
+            if repeat is False and is_corrupted(e):
+                logger.debug("Corrupted database detected, Cleaning: %s", self.path)
+                with self._lock:
+                    self.conn.cursor().close()
+                    self.conn.close()
+                    self._remove_database()
+                    self.conn = self.connect()
                 return self.execute(query, values, repeat=True)
             else:
                 raise e
 
+    def _execute(self, query, values):  # type: (str, tuple) -> sqlite3.Cursor
+        with self.conn:
+            # Automatically commits or rolls back on exception
+            return self.conn.execute(query, values)
+
     def close(self):
-        """Close the HTTPAdapter and SQLITE database."""
-        super(CacheHTTPAdapter, self).close()
-        if self._closed is False:
+        """Close the database connection."""
+        with self._lock:
             self.conn.cursor().close()
             self.conn.close()
-            self._closed = True
 
-    def get_cache(self, urlhash, max_age):  # type: (str, int) -> CacheRecord
-        """Return a cached response if one exists."""
-        result = self.execute("""SELECT key, response,
-        strftime('%s', 'now') - strftime('%s', cached_date, 'unixepoch') < ? AS fresh
-        FROM urlcache WHERE key = ?""", (max_age, urlhash))
-        record = result.fetchone()
+
+class CacheHTTPAdapter(adapters.HTTPAdapter):
+    """Requests adapter that handels https requests and caches them for later use."""
+
+    def __init__(self, cache_location, *args, **kwargs):  # type: (str, ..., ...) -> None
+        # The pool is sized once for the concurrent workers, as swapping the pool manager later
+        # would break requests that are still using the old one. Extra connections are not kept.
+        kwargs.setdefault("pool_maxsize", max(MAX_WORKERS, PREFETCH_WORKERS, adapters.DEFAULT_POOLSIZE))
+        super(CacheHTTPAdapter, self).__init__(*args, **kwargs)
+        # sqlite3.enable_callback_tracebacks(True)
+        self._lock = threading.RLock()
+        self._revalidating = set()
+        self._inflight = {}
+        self._closed = False
+        self._written = 0
+
+        #: True when this adapter is shared between sessions, see :func:`get_adapter`.
+        #: Shared adapters are not closed when a session is closed.
+        self.shared = False
+
+        # Create any missing directorys
+        self.files_dir = os.path.join(cache_location, ".urlquick.files")
+        if not os.path.exists(self.files_dir):
+            os.makedirs(self.files_dir)
+
+        #: The cache databases, cache items are split between them by cache key. See :data:`CACHE_SHARDS`.
+        #: The first database also holds the cache metadata.
+        self.shards = [CacheDatabase(path) for path in shard_paths(cache_location, CACHE_SHARDS)]
+        self.cache_file = self.shards[0].path
+
+        #: The in memory cache in front of the database, shared by all adapters using the same database.
+        self.memory_cache = get_memory_cache(self.cache_file)
+
+        #: Statistics of all requests made through this adapter, see :class:`CacheStats`.
+        self.stats = CacheStats()
+
+        self.auto_clean()  # Remove expired, if due
+
+    def close(self):
+        """Close the HTTPAdapter and SQLITE database."""
+        super(CacheHTTPAdapter, self).close()
+        with self._lock:
+            if self._closed is False:
+                for shard in self.shards:
+                    shard.close()
+                self._closed = True
+
+    @property
+    def conn(self):  # type: () -> sqlite3.Connection
+        """Connection to the first cache database."""
+        return self.shards[0].conn
+
+    def execute(self, query, values=()):  # type: (str, tuple) -> sqlite3.Cursor
+        """Execute SQL Query on the first cache database, which holds the cache metadata."""
+        return self.shards[0].execute(query, values)
+
+    def database(self, urlhash):  # type: (str) -> CacheDatabase
+        """Return the cache database that holds the given cache key."""
+        if len(self.shards) == 1:
+            return self.shards[0]
+        return self.shards[int(urlhash[:8], 16) % len(self.shards)]
+
+    @property
+    def closed(self):  # type: () -> bool
+        """True if the database connection has been closed."""
+        return self._closed
+
+    def get_cache(self, urlhash, max_age, request=None, cache_control=None):
+        # type: (str, int, PreparedRequest, str) -> CacheRecord
+        """Return a cached record if one exists, without loading the response body."""
+        now = int(time.time())
+        entry = self.memory_cache.get(urlhash)
+        if entry is not None:
+            record = dict(entry[0], age=now - entry[0]["cached_date"])
+        else:
+            result = self.database(urlhash).execute("""SELECT key, status, etag, last_modified, lifetime,
+            ? - cached_date AS age
+            FROM urlcache WHERE key = ?""", (now, urlhash))
+            record = result.fetchone()
+
         if record is not None:
+            return CacheRecord(record, max_age, self, request, cache_control)
+
+    def load_response(self, urlhash, request=None):  # type: (str, PreparedRequest) -> Response
+        """Load the full cached response, body included."""
+        entry = self.memory_cache.get(urlhash)
+        if entry is not None:
+            self._touch(urlhash, entry[0])
+            return entry[1].cached_copy(request)
+
+        result = self.database(urlhash).execute("""SELECT key, status, url, reason, encoding, headers, content, codec,
+        etag, last_modified, lifetime, in_file, last_access, cached_date FROM urlcache WHERE key = ?""", (urlhash,))
+        record = result.fetchone()
+        if record is None:
+            return None
+
+        meta = self._record_meta(record)
+        self._touch(urlhash, meta)
+
+        try:
+            if record["in_file"]:
+                # Large bodies are read from a memory mapped file, and are not kept in memory
+                with open(self.body_file(urlhash), "rb") as stream:
+                    raw = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+                return Response.from_record(record, request, raw)
+            else:
+                response = Response.from_record(record)
+        except (ValueError, EnvironmentError):
+            # Remove cache item if headers could not be decoded or the body file is missing
+            self.del_cache(urlhash)
+        else:
+            self.memory_cache.set(urlhash, meta, response)
+            return response.cached_copy(request)
+
+    def _touch(self, urlhash, meta):  # type: (str, dict) -> None
+        """Update the last access time of a cache item, used to find the least recently used items."""
+        now = int(time.time())
+        if now - meta["last_access"] >= _ACCESS_RESOLUTION:
+            meta["last_access"] = now
+            self.database(urlhash).execute("UPDATE urlcache SET last_access=? WHERE key=?", (now, urlhash))
+
+    def body_file(self, urlhash):  # type: (str) -> str
+        """Return the path to the file used to store a large response body."""
+        return os.path.join(self.files_dir, urlhash)
+
+    def set_cache(self, urlhash, resp, body_path=None):  # type: (str, Response, str) -> Response
+        """
+        Save a response to database and return original response.
+
+        Bodies larger than :data:`FILE_CACHE_THRESHOLD <urlquick.FILE_CACHE_THRESHOLD>` are stored in a file.
+        body_path can be given when the body has already been saved to a temporary file, which is then moved.
+        """
+        streamed = body_path is not None
+        if not streamed:
+            content = resp.content
+            in_file = len(content) > FILE_CACHE_THRESHOLD
+            if in_file:
+                fd, body_path = tempfile.mkstemp(dir=self.files_dir, prefix=".tmp-")
+                with os.fdopen(fd, "wb") as stream:
+                    stream.write(content)
+        else:
+            in_file = os.path.getsize(body_path) > FILE_CACHE_THRESHOLD
+            if not in_file:
+                with open(body_path, "rb") as stream:
+                    content = stream.read()
+                remove_file(body_path)
+
+        if in_file:
+            content = b""
             try:
-                return CacheRecord(record)
-            except ValueError as e:
-                # If unsupported protocol is raised, then wipe the database clean
-                # This can happen when downgrading python versions
-                if "unsupported pickle protocol" in str(e):
-                    self.wipe()
-                else:
-                    # Remove cache item
-                    self.del_cache(urlhash)
-
-    def set_cache(self, urlhash, resp):  # type: (str, Response) -> Response
-        """Save a response to database and return original response."""
-        self.execute(
-            "REPLACE INTO urlcache (key, response, cached_date) VALUES (?,?,strftime('%s', 'now'))",
-            (urlhash, resp)
+                replace_file(body_path, self.body_file(urlhash))
+            except EnvironmentError as e:
+                # The existing body file can still be in use on windows, the response is just not cached
+                logger.debug("Unable to save the response body to the cache: %s", e)
+                remove_file(body_path)
+                return resp
+        else:
+            remove_file(self.body_file(urlhash))
+
+        # Body files are left uncompressed, so they can be memory mapped
+        headers = resp.headers
+        codec, stored = (None, content) if in_file else compress_body(content, headers.get("Content-Type"))
+        raw_headers = json.dumps(dict(headers))
+        size = len(raw_headers) + (os.path.getsize(self.body_file(urlhash)) if in_file else len(stored))
+        now = int(time.time())
+        meta = {"key": urlhash, "status": resp.status_code, "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"), "lifetime": server_lifetime(headers),
+                "last_access": now, "cached_date": now}
+
+        self.database(urlhash).execute(
+            """REPLACE INTO urlcache (key, status, url, reason, encoding, headers, content, codec, etag,
+            last_modified, lifetime, in_file, size, last_access, cached_date) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
+            (urlhash, resp.status_code, resp.url, resp.reason, resp.encoding, raw_headers,
+             sqlite3.Binary(stored), codec, meta["etag"], meta["last_modified"], meta["lifetime"], in_file, size,
+             now, now)
         )
+
+        self.count_event(resp.request, "store")
+        resp.urlhash = urlhash
+
+        # Streamed and large bodies are not kept in memory
+        if in_file or streamed:
+            self.memory_cache.remove(urlhash)
+        else:
+            self.memory_cache.set(urlhash, meta, resp.cached_copy())
+
+        # Check the cache size limit, after every tenth of the limit has been written
+        self._written += size
+        if MAX_CACHE_SIZE and self._written > MAX_CACHE_SIZE // 10:
+            self.evict()
         return resp
 
+    @staticmethod
+    def _record_meta(record):  # type: (sqlite3.Row) -> dict
+        """Return the metadata of a record, as kept in the memory cache."""
+        names = ("key", "status", "etag", "last_modified", "lifetime", "last_access", "cached_date")
+        return {name: record[name] for name in names}
+
     def del_cache(self, urlhash):
         """Remove a cache item from database."""
-        self.execute(
+        self.memory_cache.remove(urlhash)
+        remove_file(self.body_file(urlhash))
+        self.database(urlhash).execute(
             "DELETE FROM urlcache WHERE key = ?",
             (urlhash,)
         )
 
-    def reset_cache(self, urlhash):  # type: (str) -> None
-        """Reset the cached date to current time."""
-        self.execute(
-            "UPDATE urlcache SET cached_date=strftime('%s', 'now') WHERE key=?",
-            (urlhash,)
+    def reset_cache(self, urlhash, lifetime=None):  # type: (str, int) -> None
+        """Reset the cached date to current time, and update the server lifetime if a new one is given."""
+        now = int(time.time())
+        self.memory_cache.update(urlhash, cached_date=now, lifetime=lifetime)
+        self.database(urlhash).execute(
+            "UPDATE urlcache SET cached_date=?, lifetime=COALESCE(?, lifetime) WHERE key=?",
+            (now, lifetime, urlhash)
+        )
+
+    def get_extracted(self, urlhash, name, default=None):  # type: (str, str, Any) -> Any
+        """Return the data extracted from a cached response body, or default if nothing was stored."""
+        name = "{}@{}".format(name, _MARSHAL_TAG)
+        record = self.database(urlhash).execute("SELECT data FROM urlextract WHERE key = ? AND name = ?",
+                                                (urlhash, name)).fetchone()
+        return default if record is None else marshal.loads(bytes(record["data"]))
+
+    def set_extracted(self, urlhash, name, data):  # type: (str, str, Any) -> None
+        """
+        Save data extracted from a cached response body. Nothing is saved if the response is not in the cache.
+
+        The data is stored using marshal, which loads faster than json, so it must only
+        contain built-in types like dict, list, tuple, str and numbers.
+        """
+        try:
+            raw = marshal.dumps(data)
+        except ValueError:
+            logger.debug("Unable to cache extracted data of type: %s", type(data))
+            return None
+
+        self.database(urlhash).execute(
+            """REPLACE INTO urlextract (key, name, data)
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM urlcache WHERE key = ?)""",
+            (urlhash, "{}@{}".format(name, _MARSHAL_TAG), sqlite3.Binary(raw), urlhash)
         )
 
     def clean(self, expires=EXPIRES):  # type: (int) -> None
         """Clean the database of expired caches."""
-        self.execute(
-            "DELETE FROM urlcache WHERE strftime('%s', 'now') - strftime('%s', cached_date, 'unixepoch') > ?",
-            (expires,)
-        )
+        now = int(time.time())
+        self.memory_cache.remove_older(now - expires)
+        for shard in self.shards:
+            for record in shard.execute("SELECT key FROM urlcache WHERE cached_date < ? AND in_file = 1",
+                                        (now - expires,)).fetchall():
+                remove_file(self.body_file(record["key"]))
+            shard.execute("DELETE FROM urlcache WHERE cached_date < ?", (now - expires,))
+            shard.execute("DELETE FROM urlvary WHERE cached_date < ?", (now - expires,))
+        self.execute("REPLACE INTO urlmeta (name, value) VALUES ('last_clean', ?)", (now,))
+        self.clean_files(now - _ORPHAN_FILE_AGE)
+        self.evict()
+
+    def clean_files(self, before):  # type: (int) -> int
+        """
+        Remove files, last modified before the given time, that don't belong to a cache item. These are temporary
+        files left by streamed responses that were never finished, and body files of items removed along with a
+        corrupted database.
+
+        :returns: The number of files removed.
+        """
+        stored = set()
+        for shard in self.shards:
+            stored.update(record["key"] for record in shard.execute("SELECT key FROM urlcache WHERE in_file = 1"))
+
+        removed = 0
+        for filename in os.listdir(self.files_dir):
+            path = os.path.join(self.files_dir, filename)
+            try:
+                orphaned = filename not in stored and os.path.getmtime(path) < before
+            except OSError:
+                continue
+
+            if orphaned:
+                remove_file(path)
+                removed += 1
+        return removed
+
+    def evict(self, max_size=None):  # type: (int) -> int
+        """
+        Remove the least recently used cache items, when the total size of the cache is over the limit.
+        Items are removed until the cache is back under 90% of the limit, and then the freed pages are vacuumed.
+        Defaults to :data:`MAX_CACHE_SIZE <urlquick.MAX_CACHE_SIZE>`.
+
+        :returns: The number of cache items removed.
+        """
+        max_size = MAX_CACHE_SIZE if max_size is None else max_size
+        self._written = 0
+        if not max_size:
+            return 0
+
+        total = sum(shard.execute("SELECT COALESCE(SUM(size), 0) FROM urlcache").fetchone()[0]
+                    for shard in self.shards)
+        if total <= max_size:
+            return 0
+
+        def oldest(index, shard):
+            # Rows are read in order using the last access index, only as far as needed
+            for record in shard.execute("SELECT key, url, size, last_access FROM urlcache ORDER BY last_access"):
+                yield record["last_access"], index, record["key"], record["url"], record["size"]
+
+        # The size limit applies to all shards combined, so the least recently used items are taken from all of them
+        to_free = total - int(max_size * 0.9)
+        evicted = []
+        readers = [oldest(*shard) for shard in enumerate(self.shards)]
+        for _, index, urlhash, url, size in heapq.merge(*readers):
+            if to_free <= 0:
+                break
+            evicted.append((urlhash, self.shards[index]))
+            to_free -= size
+            self.stats.count(urlsplit(url).hostname or "", "evict")
+
+        # Finish the reads before deleting
+        for reader in readers:
+            reader.close()
+
+        logger.debug("Cache is over the size limit, removing %d least recently used items", len(evicted))
+        for urlhash, shard in evicted:
+            self.memory_cache.remove(urlhash)
+            remove_file(self.body_file(urlhash))
+            shard.execute("DELETE FROM urlcache WHERE key = ?", (urlhash,))
+        for shard in self.shards:
+            shard.execute("PRAGMA incremental_vacuum")
+        return len(evicted)
+
+    def auto_clean(self, interval=None):  # type: (int) -> bool
+        """
+        Clean the database of expired caches, only if the last cleanup was
+        longer ago than the given interval. Defaults to :data:`CLEAN_INTERVAL <urlquick.CLEAN_INTERVAL>`.
+
+        :returns: True if the database was cleaned.
+        """
+        interval = CLEAN_INTERVAL if interval is None else interval
+        record = self.execute("SELECT value FROM urlmeta WHERE name = 'last_clean'").fetchone()
+        if record is None or time.time() - record["value"] >= interval:
+            logger.debug("Removing expired cache items")
+            self.clean()
+            return True
+        return False
 
     def wipe(self):
         """Wipe the database clean."""
-        self.execute("DELETE FROM urlcache")
+        self.memory_cache.clear()
+        for shard in self.shards:
+            shard.execute("DELETE FROM urlcache")
+            shard.execute("DELETE FROM urlvary")
+        for filename in os.listdir(self.files_dir):
+            remove_file(os.path.join(self.files_dir, filename))
 
     # noinspection PyShadowingNames
     def send(self, request, **kwargs):  # type: (PreparedRequest, ...) -> Response
         max_age = int(request.headers.pop("x-cache-max-age"))
-        urlhash = hash_url(request) if max_age >= 0 else None
-        cache = None
+        stale_while_revalidate = int(request.headers.pop("x-cache-swr", 0))
+        stale_if_error = int(request.headers.pop("x-cache-sie", 0))
+        stale_timeout = request.headers.pop("x-cache-sie-timeout", None)
+        cache_control = request.headers.pop("x-cache-control", None)
+        urlhash = request.headers.pop("x-cache-key", None)
+        urlhash = (urlhash or hash_url(request)) if max_age >= 0 else None
 
         # Check if request is already cached and valid
+        cache = self.check_cache(request, urlhash, max_age, cache_control)
+        if cache and cache.isfresh:
+            return cache.response
+
+        # Return the stale response straight away and revalidate later
+        elif cache and cache.age < cache.lifetime + stale_while_revalidate and cache.response is not None:
+            logger.debug("Cache is stale, deferring revalidation")
+            self.defer_revalidation(urlhash, request, kwargs, cache_control)
+            response = cache.response
+            response.is_stale = True
+            self.count_event(request, "stale")
+            self.count_event(request, "bytes_cached", body_size(response))
+            return response
+
+        # The stale response can be used if the request fails
+        if cache and cache.age < cache.lifetime + stale_if_error:
+            fallback = cache
+            if stale_timeout:
+                timeout = tuple(float(value) for value in stale_timeout.split(","))
+                kwargs = dict(kwargs, timeout=timeout if len(timeout) > 1 else timeout[0])
+        else:
+            fallback = None
+
+        # Wait for an identical request that is already in flight, then check the cache again
         if urlhash and request.method in CACHEABLE_METHODS:
-            cache = self.get_cache(urlhash, max_age)
+            with self._lock:
+                inflight = self._inflight.get(urlhash)
+                # Streamed responses are only cached once consumed, so they can't be shared
+                leader = inflight is None and not kwargs.get("stream", False)
+                if leader:
+                    inflight = self._inflight[urlhash] = threading.Event()
+
+            if leader:
+                try:
+                    return self._send(request, cache, urlhash, cache_control, kwargs, fallback)
+                finally:
+                    with self._lock:
+                        del self._inflight[urlhash]
+                    inflight.set()
+
+            elif inflight is not None:
+                logger.debug("Identical request in flight, waiting for response")
+                inflight.wait()
+                cache = self.check_cache(request, urlhash, max_age, cache_control)
+                if cache and cache.isfresh:
+                    return cache.response
+
+        return self._send(request, cache, urlhash, cache_control, kwargs, fallback)
+
+    def _send(self, request, cache, urlhash, cache_control, kwargs, fallback=None):
+        # type: (PreparedRequest, CacheRecord, str, str, dict, CacheRecord) -> Response
+        """
+        Send request for remote resource, and save the response to cache.
+        If a fallback cache record is given, its stale response is returned if the request fails.
+        """
+        start = time.time()
+        try:
+            response = super(CacheHTTPAdapter, self).send(request, **kwargs)
+            if fallback is not None and not kwargs.get("stream", False):
+                # Read the body now, so that errors while reading it can also fallback to the cache
+                response.content
+        except (ConnectionError, Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if fallback is None or fallback.response is None:
+                raise
+            logger.debug("Request failed, using stale response: %s", e)
+            return self._stale_response(request, fallback)
+        self.time_event(request, "network", time.time() - start)
+
+        if fallback is not None and response.status_code in SERVER_ERROR_CODES and fallback.response is not None:
+            logger.debug("Server error %s, using stale response", response.status_code)
+            response.close()
+            return self._stale_response(request, fallback)
+        elif urlhash:
+            return self.process_response(response, cache, urlhash, cache_control, kwargs.get("stream", False))
+        return response
+
+    def _stale_response(self, request, cache):  # type: (PreparedRequest, CacheRecord) -> Response
+        """Return the stale response of a cache record, flagged as stale."""
+        response = cache.response
+        response.is_stale = True
+        self.count_event(request, "stale_error")
+        self.count_event(request, "bytes_cached", body_size(response))
+        return response
+
+    def defer_revalidation(self, urlhash, request, kwargs, cache_control=None):
+        # type: (str, PreparedRequest, dict, str) -> None
+        """Revalidate the cached response later, when :func:`run_deferred` is called."""
+        with self._lock:
+            if urlhash in self._revalidating:
+                return None
+            self._revalidating.add(urlhash)
+
+        def revalidate():
+            try:
+                request.headers["x-cache-max-age"] = "0"
+                request.headers["x-cache-key"] = urlhash
+                if cache_control:
+                    request.headers["x-cache-control"] = cache_control
+                self.send(request, **kwargs).close()
+            finally:
+                self._revalidating.discard(urlhash)
+
+        defer(revalidate)
+
+    def variant_key(self, urlhash, headers, vary=None):  # type: (str, CaseInsensitiveDict, list) -> str
+        """
+        Return the cache key of the response variant that matches the request headers.
+
+        The request headers that responses vary on are recorded per cache key. When the names
+        from the Vary header of a new response are given, the recorded names are updated.
+        The key is returned unchanged if the responses don't vary.
+
+        Recorded names are kept in the memory cache, so the database is only
+        queried for keys not seen before, and only written when the names change.
+        """
+        database = self.database(urlhash)
+        recorded = self.memory_cache.get_vary(urlhash)
+        if recorded is None:
+            record = database.execute("SELECT headers FROM urlvary WHERE key = ?", (urlhash,)).fetchone()
+            recorded = json.loads(record["headers"]) if record else []
+            self.memory_cache.set_vary(urlhash, recorded)
+
+        if vary is None:
+            vary = recorded
+        else:
+            names = vary if "*" not in vary else []
+            if names != recorded:
+                if names:
+                    database.execute("REPLACE INTO urlvary (key, headers, cached_date) VALUES (?,?,?)",
+                                     (urlhash, json.dumps(names), int(time.time())))
+                else:
+                    database.execute("DELETE FROM urlvary WHERE key = ?", (urlhash,))
+                self.memory_cache.set_vary(urlhash, names)
+
+        if not vary or "*" in vary:
+            return urlhash
+
+        # Whitespace is not significant in header values
+        values = [" ".join(headers[name].split()) if name in headers else None for name in vary]
+        return hashlib.sha1(to_bytes_string(urlhash + json.dumps(list(zip(vary, values))))).hexdigest()
+
+    def check_cache(self, request, urlhash, max_age, cache_control=None):
+        # type: (PreparedRequest, str, int, str) -> CacheRecord
+        """
+        Return the cache record for the request, if one exists.
+        Conditional headers are added to the request when the cache is stale.
+        """
+        if urlhash and request.method in CACHEABLE_METHODS:
+            start = time.time()
+            urlhash = self.variant_key(urlhash, request.headers)
+            cache = self.get_cache(urlhash, max_age, request, cache_control)
             if cache and cache.isfresh:
                 logger.debug("Cache is fresh")
-                return cache.response
+                self.count_event(request, "fresh")
+                self.count_event(request, "bytes_cached", body_size(cache.response))
             elif cache:
                 # Allows for Not Modified check
                 logger.debug("Cache is stale, adding conditional headers to request")
                 cache.add_conditional_headers(request.headers)
-
-        # Send request for remote resource
-        response = super(CacheHTTPAdapter, self).send(request, **kwargs)
-        return self.process_response(response, cache, urlhash) if urlhash else response
+            self.time_event(request, "lookup", time.time() - start)
+            return cache
+
+    def count_event(self, request, name, value=1):  # type: (PreparedRequest, str, int) -> None
+        """Count a cache event in the adapter statistics, and the statistics of the session that made the request."""
+        host = (urlsplit(request.url).hostname or "") if request is not None else ""
+        for stats in (self.stats, getattr(request, "cache_stats", None)):
+            if stats is not None:
+                stats.count(host, name, value)
+
+    def time_event(self, request, name, seconds):  # type: (PreparedRequest, str, float) -> None
+        """Time a cache event in the adapter statistics, and the statistics of the session that made the request."""
+        host = urlsplit(request.url).hostname or ""
+        for stats in (self.stats, getattr(request, "cache_stats", None)):
+            if stats is not None:
+                stats.timing(host, name, seconds)
+
+    def dump_stats(self):  # type: () -> None
+        """Add the statistics to the totals saved in the cache location."""
+        self.stats.dump(os.path.join(os.path.dirname(self.cache_file), _STATS_FILENAME))
 
     def build_response(self, req, resp):  # type: (PreparedRequest, HTTPResponse) -> Response
         """Replace response object with our customized version."""
         resp = super(CacheHTTPAdapter, self).build_response(req, resp)
         return Response.extend_response(resp)
 
-    def process_response(self, response, cache, urlhash):  # type: (Response, CacheRecord, str) -> Response
+    def process_response(self, response, cache, urlhash, cache_control=None, stream=False):
+        # type: (Response, CacheRecord, str, str, bool) -> Response
         """Save response to cache if possible."""
+        request = response.request
+
+        # Not Modified responses may leave out the Vary header, so use the recorded names
+        vary = parse_vary(response.headers)
+        if not vary and response.status_code == codes.not_modified:
+            vary = None
+        urlhash = self.variant_key(urlhash, response.request.headers, vary)
+
         # Check for Not Modified response
-        if cache and response.status_code == codes.not_modified:
+        if cache and response.status_code == codes.not_modified and cache.response is not None:
             logger.debug("Server return 304 Not Modified response, using cached response")
             response.close()
-            self.reset_cache(urlhash)
+            self.reset_cache(urlhash, server_lifetime(response.headers))
             response = cache.response
+            self.count_event(request, "revalidated")
+            self.count_event(request, "bytes_cached", body_size(response))
+
+        # Honor requests to not store the response, if server cache headers are enabled
+        elif cache_control and (is_no_store(response.headers) or is_no_store(response.request.headers)):
+            logger.debug("Response is marked as no-store, skipping cache")
+            if cache:
+                self.del_cache(urlhash)
+
+        # A response that varies on everything can never be matched to a request
+        elif vary and "*" in vary:
+            logger.debug("Response varies on all request headers, skipping cache")
 
-        # Cache any cacheable responses
+        # Streamed responses are cached once the caller has read the full body
         elif response.request.method in CACHEABLE_METHODS and response.status_code in CACHEABLE_CODES:
-            logger.debug("Caching %s %s response", response.status_code, response.reason)
-            response = self.set_cache(urlhash, response)
+            if stream:
+                response.raw = CacheWriter(response.raw, self, urlhash, response)
+            else:
+                logger.debug("Caching %s %s response", response.status_code, response.reason)
+                response = self.set_cache(urlhash, response)
 
+        if request.method in CACHEABLE_METHODS and not response.from_cache:
+            self.count_event(request, "miss")
         return response
 
 
+class PersistentCookieJar(RequestsCookieJar):
+    """
+    Cookie jar that is saved to a sqlite database, so cookies are kept between add-on invocations.
+
+    Cookies are loaded when the jar is created. Only the changes made since then are written by :meth:`save`,
+    so processes sharing the same database don't overwrite each other's cookies.
+    Expired cookies are removed when loading, along with session cookies that are older
+    than :data:`SESSION_COOKIE_EXPIRES <urlquick.SESSION_COOKIE_EXPIRES>`.
+    """
+
+    def __init__(self, filename, policy=None):  # type: (str, cookielib.CookiePolicy) -> None
+        super(PersistentCookieJar, self).__init__(policy)
+        self._changes_lock = threading.Lock()
+        self._changes = []
+        self.filename = filename
+        self.load()
+
+    def __getstate__(self):
+        state = super(PersistentCookieJar, self).__getstate__()
+        state.pop("_changes_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        super(PersistentCookieJar, self).__setstate__(state)
+        self._changes_lock = threading.Lock()
+
+    def copy(self):  # type: () -> RequestsCookieJar
+        """Return an in memory copy of the cookies, changes to the copy are not saved."""
+        new_cj = RequestsCookieJar()
+        new_cj.set_policy(self.get_policy())
+        new_cj.update(self)
+        return new_cj
+
+    def set_cookie(self, cookie, *args, **kwargs):
+        super(PersistentCookieJar, self).set_cookie(cookie, *args, **kwargs)
+        with self._changes_lock:
+            self._changes.append((cookie, None))
+
+    def clear(self, domain=None, path=None, name=None):
+        super(PersistentCookieJar, self).clear(domain, path, name)
+        with self._changes_lock:
+            self._changes.append((None, (domain, path, name)))
+
+    def connect(self):  # type: () -> sqlite3.Connection
+        """Connect to the cookie database, creating the directory and table if missing."""
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        conn = sqlite3.connect(self.filename, timeout=BUSY_TIMEOUT)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                conn.execute("""CREATE TABLE IF NOT EXISTS cookies(
+                    domain TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    value TEXT,
+                    secure INTEGER NOT NULL,
+                    expires INTEGER,
+                    port TEXT,
+                    version INTEGER,
+                    rest TEXT NOT NULL,
+                    created INTEGER NOT NULL,
+                    PRIMARY KEY (domain, path, name)
+                )""")
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def load(self):  # type: () -> None
+        """Load the saved cookies that have not expired, replacing any cookies with the same name."""
+        try:
+            records = retry_busy(self._load)
+        except sqlite3.DatabaseError as e:
+            if not is_corrupted(e):
+                raise CacheError(str(e))
+            logger.debug("Corrupted cookie database detected, Cleaning...")
+            remove_file(self.filename)
+            return None
+
+        for record in records:
+            cookie = create_cookie(record["name"], record["value"], domain=record["domain"], path=record["path"],
+                                   secure=bool(record["secure"]), expires=record["expires"], port=record["port"],
+                                   version=record["version"], discard=record["expires"] is None,
+                                   rest=json.loads(record["rest"]))
+            # Loaded cookies are already saved, so skip change tracking
+            super(PersistentCookieJar, self).set_cookie(cookie)
+
+    def _load(self):  # type: () -> list
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM cookies WHERE expires <= ? OR (expires IS NULL AND created < ?)",
+                             (now, now - SESSION_COOKIE_EXPIRES))
+                return conn.execute("SELECT * FROM cookies").fetchall()
+        finally:
+            conn.close()
+
+    def save(self):  # type: () -> None
+        """Write the cookies that were set or removed since the last save."""
+        with self._changes_lock:
+            changes, self._changes = self._changes, []
+        if not changes:
+            return None
+
+        try:
+            retry_busy(self._save, changes)
+        except sqlite3.DatabaseError as e:
+            if not is_corrupted(e):
+                raise CacheError(str(e))
+            # Start over with the cookies of this jar, cookies saved by other processes are lost
+            logger.debug("Corrupted cookie database detected, Cleaning...")
+            remove_file(self.filename)
+            retry_busy(self._save, [(cookie, None) for cookie in iter(self)])
+
+    def _save(self, changes):  # type: (list) -> None
+        now = int(time.time())
+        conn = self.connect()
+        try:
+            with conn:
+                for cookie, cleared in changes:
+                    if cookie is None:
+                        # Clear all cookies, or only those matching the given domain, path and name
+                        where = [(column, value) for column, value in zip(("domain", "path", "name"), cleared)
+                                 if value is not None]
+                        query = " AND ".join("{} = ?".format(column) for column, _ in where)
+                        conn.execute("DELETE FROM cookies WHERE " + (query or "1"), tuple(value for _, value in where))
+                    else:
+                        conn.execute("REPLACE INTO cookies VALUES (?,?,?,?,?,?,?,?,?,?)", (
+                            cookie.domain, cookie.path, cookie.name, cookie.value, cookie.secure, cookie.expires,
+                            cookie.port, cookie.version, json.dumps(cookie._rest), now))
+        finally:
+            conn.close()
+
+
 class Session(sessions.Session):
+    """
+    Requests session with support for http caching.
+
+    By default the session attaches to the process wide :class:`CacheHTTPAdapter` for the given
+    cache location, so the connection pool and database connection are reused between sessions.
+    A custom adapter can be given using the ``cache_adapter`` keyword argument.
+    Cookies are kept between add-on invocations when ``persist_cookies=True`` is given,
+    see :class:`PersistentCookieJar`.
+    """
+
     def __init__(self, cache_location=CACHE_LOCATION, **kwargs):  # type: (str, ...) -> None
         super(Session, self).__init__()
 
@@ -404,10 +2029,82 @@ class Session(sessions.Session):
         #: Defaults to :data:`MAX_AGE <urlquick.MAX_AGE>`
         self.max_age = kwargs.get("max_age", MAX_AGE)
 
-        self.cache_adapter = adapter = CacheHTTPAdapter(cache_location)
+        #: Honor the server cache headers "Cache-Control", "Expires" and "Age" when deciding if the cache is fresh.
+        #: The value decides how the server freshness lifetime is combined with :attr:`max_age`.
+        #: ``"server"`` (or True) uses the server lifetime, falling back to max_age if the server gives none.
+        #: ``"upper"`` uses max_age as an upper bound and ``"lower"`` uses max_age as a lower bound.
+        #: "no-store" and "no-cache" are always honored. Defaults to None (disabled).
+        self.cache_control = kwargs.get("cache_control")
+
+        #: Time in seconds, after the cache becomes stale, where the stale response is returned straight away
+        #: and the cache is revalidated later, when :func:`run_deferred` is called. Defaults to 0 (disabled).
+        #: codequick calls :func:`close_session` after every callback. Other callers should do the same,
+        #: otherwise the revalidation waits :data:`DEFERRED_TIMEOUT` and then runs in a background thread.
+        self.stale_while_revalidate = kwargs.get("stale_while_revalidate", 0)
+
+        #: Time in seconds, after the cache becomes stale, where the stale response is returned if the
+        #: request fails with a connection error, a timeout or a server error. Defaults to 0 (disabled).
+        self.stale_if_error = kwargs.get("stale_if_error", 0)
+
+        #: Timeout in seconds used instead of the request timeout, when a stale response can be returned
+        #: on error. Can be a (connect, read) tuple. Keeps listings quick when a server is slow to respond.
+        #: Defaults to None, where the request timeout is used.
+        self.stale_timeout = kwargs.get("stale_timeout")
+
+        #: Normalization rules used to build the cache key of each request, see :class:`CacheKey`.
+        #: Defaults to None, where the cache key is built from the exact url, method and body.
+        self.cache_key = kwargs.get("cache_key")
+
+        #: Statistics of the requests made by this session, see :class:`CacheStats`.
+        #: The adapter also keeps statistics of all sessions using it.
+        self.stats = CacheStats()
+
+        # Keep cookies between add-on invocations, so logins and consent cookies are not lost
+        if kwargs.get("persist_cookies", False):
+            self.cookies = PersistentCookieJar(os.path.join(cache_location, _COOKIES_FILENAME))
+
+        self._cache_location = cache_location
+        adapter = kwargs.get("cache_adapter")
+        self._mount_adapter(get_adapter(cache_location) if adapter is None else adapter)
+
+    @property
+    def cache_adapter(self):  # type: () -> CacheHTTPAdapter
+        """
+        The cache adapter used by this session.
+
+        A shared adapter that was closed by :func:`close_session` is replaced by the new shared adapter,
+        so sessions that outlive the call to :func:`close_session` keep working.
+        """
+        return self._reattach_adapter()
+
+    def _reattach_adapter(self):  # type: () -> CacheHTTPAdapter
+        """Mount the new shared adapter, if the shared adapter was closed by :func:`close_session`."""
+        adapter = self._cache_adapter
+        if adapter.shared and adapter.closed:
+            adapter = get_adapter(self._cache_location)
+            self._mount_adapter(adapter)
+        return adapter
+
+    def _mount_adapter(self, adapter):  # type: (CacheHTTPAdapter) -> None
+        self._cache_adapter = adapter
         self.mount("https://", adapter)
         self.mount("http://", adapter)
 
+    def close(self):
+        """
+        Close all adapters, except for shared adapters which are closed by :func:`close_session`.
+        Persistent cookies are saved first.
+        """
+        self.save_cookies()
+        for adapter in self.adapters.values():
+            if not getattr(adapter, "shared", False):
+                adapter.close()
+
+    def save_cookies(self):  # type: () -> None
+        """Save any changed cookies, when the session was created with ``persist_cookies=True``."""
+        if isinstance(self.cookies, PersistentCookieJar):
+            self.cookies.save()
+
     def _raise_for_status(self, response, raise_for_status):  # type: (Response, bool) -> None
         """Raise :class:`HTTPError` if status code is between 400 and 600."""
         if self.raise_for_status if raise_for_status is None else raise_for_status:
@@ -417,6 +2114,31 @@ class Session(sessions.Session):
         """Return a valid max age. Use session value if request did not containe one."""
         return (-1 if self.max_age is None else self.max_age) if max_age is None else max_age
 
+    def _add_cache_headers(self, headers, kwargs):  # type: (dict, dict) -> None
+        """Add the cache options to the request headers, so the adapter can access them."""
+        headers["x-cache-max-age"] = str(self._merge_max_age(kwargs.pop("max_age", None)))
+        stale_while_revalidate = kwargs.pop("stale_while_revalidate", None)
+        if stale_while_revalidate is None:
+            stale_while_revalidate = self.stale_while_revalidate
+        headers["x-cache-swr"] = str(stale_while_revalidate or 0)
+
+        stale_if_error = kwargs.pop("stale_if_error", None)
+        stale_if_error = self.stale_if_error if stale_if_error is None else stale_if_error
+        headers["x-cache-sie"] = str(stale_if_error or 0)
+        stale_timeout = kwargs.pop("stale_timeout", None)
+        stale_timeout = self.stale_timeout if stale_timeout is None else stale_timeout
+        if stale_timeout:
+            timeouts = stale_timeout if isinstance(stale_timeout, (tuple, list)) else (stale_timeout,)
+            headers["x-cache-sie-timeout"] = ",".join(str(value) for value in timeouts)
+
+        cache_control = kwargs.pop("cache_control", None)
+        cache_control = self.cache_control if cache_control is None else cache_control
+        if cache_control:
+            cache_control = "server" if cache_control is True else cache_control
+            if cache_control not in CACHE_CONTROL_MODES:
+                raise ValueError("unknown cache_control mode: {}".format(cache_control))
+            headers["x-cache-control"] = cache_control
+
     def request(self, *args, **kwargs):  # type: (...) -> Response
         # Sometimes people pass in None for headers
         # So we need to keep this in mind
@@ -429,8 +2151,7 @@ class Session(sessions.Session):
             kwargs["headers"] = headers
 
         # Add max age to headers so the adapter can access it
-        max_age = self._merge_max_age(kwargs.pop("max_age", None))
-        headers["x-cache-max-age"] = str(max_age)
+        self._add_cache_headers(headers, kwargs)
 
         # This is here to indicate to 'self.send' that it's been called internally
         # This is to pervent 'self.send' checking for max age & raise_for_status
@@ -443,21 +2164,189 @@ class Session(sessions.Session):
 
     # noinspection PyShadowingNames
     def send(self, request, **kwargs):  # type: (PreparedRequest, ...) -> Response
+        self._reattach_adapter()
+
         # If the headers does not contain 'x-cache-internal' then this method
         # must be getting called directly, so check for extra parameters
+        request.cache_stats = self.stats
+        if self.cache_key is not None:
+            request.headers["x-cache-key"] = self.cache_key(request)
+
         if request.headers.pop("x-cache-internal", None):
-            return super(Session, self).send(request, **kwargs)
+            response = super(Session, self).send(request, **kwargs)
+            self.save_cookies()
+            return response
         else:
             # Add max age to request headers
-            max_age = self._merge_max_age(kwargs.pop("max_age", None))
-            request.headers["x-cache-max-age"] = str(max_age)
+            self._add_cache_headers(request.headers, kwargs)
 
             # Make request and check for status code
             raise_for_status = kwargs.pop("raise_for_status", None)
             response = super(Session, self).send(request, **kwargs)
+            self.save_cookies()
             self._raise_for_status(response, raise_for_status)
             return response
 
+    def get_extracted(self, url, extractor, version=0, **kwargs):  # type: (str, Callable, int, ...) -> Any
+        """
+        Make a GET request and return the data extracted from the response, caching the extracted data.
+
+        The extracted data is cached along with the response, keyed by the extractor's name and version.
+        When the response comes from the cache, or the server reports that it was not modified,
+        the cached data is returned without calling the extractor again. The cached data is
+        discarded whenever the response body changes.
+
+        The extractor is identified by its module and name, so use a named function not a lambda.
+        Change the version when the extractor changes, to discard data from older versions.
+
+        :param str url: The url of the resource.
+        :param extractor: Function that takes the :class:`Response` and returns the extracted data,
+                          made up of built-in types like dict, list, tuple, str and numbers.
+        :param int version: [opt] Version of the extractor. (default => 0)
+        :param kwargs: Keyword arguments that will be passed to :meth:`request`.
+
+        :return: The extracted data.
+        """
+        response = self.request("GET", url, **kwargs)
+        urlhash = response.urlhash
+        if urlhash is None:
+            # Only data extracted from the stored body can be cached, e.g. not from error responses
+            return extractor(response)
+
+        name = "{}.{}:{}".format(getattr(extractor, "__module__", ""), getattr(extractor, "__name__", ""), version)
+        if response.from_cache:
+            data = self.cache_adapter.get_extracted(urlhash, name, _MISSING)
+            if data is not _MISSING:
+                return data
+
+        data = extractor(response)
+        self.cache_adapter.set_extracted(urlhash, name, data)
+        return data
+
+    def get_json(self, url, **kwargs):  # type: (str, ...) -> Any
+        """
+        Make a GET request and return the decoded json response.
+
+        The decoded json is cached along with the response, so when the response comes
+        from the cache, the json body does not have to be decoded again.
+        See :meth:`get_extracted`.
+
+        :param str url: The url of the resource.
+        :param kwargs: Keyword arguments that will be passed to :meth:`request`.
+
+        :return: The decoded json.
+        """
+        return self.get_extracted(url, decode_json, **kwargs)
+
+    def prefetch(self, urls, max_age=None, max_workers=None, max_bytes=None, **kwargs):
+        """
+        Queue urls to be fetched into the cache in the background, so they are already cached when requested.
+
+        The fetches are deferred until :func:`run_deferred` is called, which codequick
+        does after the listing has been sent to Kodi, or until :data:`DEFERRED_TIMEOUT` has passed.
+        Urls that are repeated, or that already have a fresh cache entry, are skipped.
+        No new fetches are started once the byte budget has been used.
+        Errors are logged and ignored.
+
+        :param urls: List of urls to prefetch.
+        :param int max_age: [opt] Age the 'cache' can be, before it’s considered stale.
+        :param int max_workers: [opt] Maximum number of concurrent requests. (default => :data:`PREFETCH_WORKERS`)
+        :param int max_bytes: [opt] Maximum number of bytes to download. (default => :data:`PREFETCH_BYTES`)
+        :param kwargs: Keyword arguments that will be passed to every request, like headers or params.
+        """
+        defer(self._prefetch, list(urls), max_age, max_workers, max_bytes, kwargs)
+
+    def _prefetch(self, urls, max_age, max_workers, max_bytes, kwargs):  # type: (list, int, int, int, dict) -> None
+        max_age = self._merge_max_age(max_age)
+        max_bytes = PREFETCH_BYTES if max_bytes is None else max_bytes
+        if max_age < 0:
+            return None
+
+        adapter = self.cache_adapter
+        cache_control = "server" if self.cache_control is True else self.cache_control
+        pending = []
+        seen = set()
+        for url in urls:
+            request = self.prepare_request(Request("GET", url, headers=kwargs.get("headers"),
+                                                   params=kwargs.get("params")))
+            urlhash = hash_url(request) if self.cache_key is None else self.cache_key(request)
+            urlhash = adapter.variant_key(urlhash, request.headers)
+            if urlhash not in seen:
+                seen.add(urlhash)
+                cache = adapter.get_cache(urlhash, max_age, cache_control=cache_control)
+                if not (cache and cache.age < cache.lifetime):
+                    pending.append(url)
+
+        lock = threading.Lock()
+        downloaded = [0]
+        # Errors are only logged, so the status is never raised, even if requested
+        options = dict(kwargs, max_age=max_age, raise_for_status=False)
+
+        def fetch(url):
+            if downloaded[0] >= max_bytes:
+                return None
+            response = self.request("GET", url, **options)
+            if not response.from_cache:
+                with lock:
+                    downloaded[0] += len(response.content)
+            response.close()
+
+        max_workers = max_workers or PREFETCH_WORKERS
+        for index, _, error in iter_concurrent(fetch, pending, max_workers):
+            if error is not None:
+                logger.debug("Failed to prefetch %s: %s", pending[index], error)
+        logger.debug("Prefetched %d urls, downloading %d bytes", len(pending), downloaded[0])
+
+    def fetch_many(self, urls, method="GET", max_workers=None, as_completed=False, **kwargs):
+        """
+        Make multiple requests concurrently, using a bounded pool of worker threads.
+        The requests share the http cache and connection pool of this session. The pool keeps
+        connections for :data:`MAX_WORKERS` workers, connections of any extra workers are not reused.
+
+        :param urls: List of urls to request. An item can also be a dict of keyword arguments for
+                     :meth:`request`, which must contain the 'url' and can override the 'method'.
+        :param str method: [opt] The http method for items that don't specify one. (default => "GET")
+        :param int max_workers: [opt] Maximum number of concurrent requests. (default => :data:`MAX_WORKERS`)
+        :param bool as_completed: [opt] If True, return a generator that yields (item, response) tuples
+                                  in the order that the requests complete. (default => False)
+        :param kwargs: Keyword arguments that will be passed to every request.
+
+        :raises RequestException: The first error raised by any of the requests.
+        :return: List of responses, in the same order as the given urls.
+        :rtype: list[Response]
+        """
+        items = list(urls)
+        max_workers = max_workers or MAX_WORKERS
+
+        def send(item):
+            options = dict(kwargs, **item) if isinstance(item, dict) else dict(kwargs, url=item)
+            options.setdefault("method", method)
+            return self.request(**options)
+
+        results = iter_concurrent(send, items, max_workers)
+        if as_completed:
+            return ((items[index], response) for index, response, _ in self._raise_errors(results))
+
+        responses = [None] * len(items)
+        errors = {}
+        for index, response, error in results:
+            responses[index] = response
+            if error is not None:
+                errors[index] = error
+
+        # Raise the error of the first failed request
+        if errors:
+            raise errors[min(errors)]
+        return responses
+
+    @staticmethod
+    def _raise_errors(results):
+        """Raise any error as soon as it's encountered."""
+        for index, response, error in results:
+            if error is not None:
+                raise error
+            yield index, response, error
+
     def get(self, url, **kwargs):  # type: (...) -> Response
         return super(Session, self).get(url, **kwargs)
 
@@ -480,10 +2369,138 @@ class Session(sessions.Session):
         return super(Session, self).delete(url, **kwargs)
 
 
+# Process wide shared session & adapters
+_shared_lock = threading.RLock()
+_shared_adapters = {}
+_shared_session = None
+_memory_caches = {}
+_deferred = []
+_deferred_thread = None
+
+
+def get_adapter(cache_location=CACHE_LOCATION):  # type: (str) -> CacheHTTPAdapter
+    """
+    Return the process wide cache adapter for the given cache location.
+
+    The adapter is created on first use and is then shared by all sessions,
+    so the connection pool and database connection only get setup once.
+    """
+    with _shared_lock:
+        adapter = _shared_adapters.get(cache_location)
+        if adapter is None or adapter.closed:
+            adapter = CacheHTTPAdapter(cache_location)
+            adapter.shared = True
+            _shared_adapters[cache_location] = adapter
+        return adapter
+
+
+def defer(func, *args, **kwargs):
+    """
+    Register a function to be called later, by :func:`run_deferred`.
+    Used for tasks like cache revalidation, that can wait until after the content has been shown.
+
+    If :func:`run_deferred` is not called within :data:`DEFERRED_TIMEOUT` seconds,
+    the tasks are run by a background thread instead.
+    """
+    global _deferred_thread
+    with _shared_lock:
+        _deferred.append((func, args, kwargs))
+        if _deferred_thread is None:
+            _deferred_thread = threading.Thread(target=_deferred_worker, name="urlquick-deferred")
+            _deferred_thread.daemon = True
+            _deferred_thread.start()
+
+
+def _deferred_worker():  # type: () -> None
+    """Run the deferred tasks that are still waiting after the timeout, until there are none left."""
+    global _deferred_thread
+    while True:
+        time.sleep(DEFERRED_TIMEOUT)
+        run_deferred()
+        with _shared_lock:
+            if not _deferred:
+                _deferred_thread = None
+                return None
+
+
+def run_deferred():  # type: () -> None
+    """Run all deferred tasks, in the order they were registered. Errors are logged and ignored."""
+    while True:
+        with _shared_lock:
+            if not _deferred:
+                return None
+            func, args, kwargs = _deferred.pop(0)
+
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.exception("Deferred task failed: %s", e)
+
+
+def get_memory_cache(cache_file):  # type: (str) -> MemoryCache
+    """
+    Return the process wide in memory cache for the given cache database.
+
+    Memory caches are kept for the life of the process, so they can be reused
+    when the interpreter is reused between add-on invocations.
+    """
+    with _shared_lock:
+        memory_cache = _memory_caches.get(cache_file)
+        if memory_cache is None:
+            memory_cache = _memory_caches[cache_file] = MemoryCache()
+        return memory_cache
+
+
+class _NoCookiesPolicy(cookielib.DefaultCookiePolicy):
+    """Cookie policy that rejects all cookies set by servers."""
+
+    def set_ok(self, cookie, request):
+        return False
+
+
+def get_session():  # type: () -> Session
+    """
+    Return the process wide session used by the module level request functions.
+
+    The session is created on first use and will stay open until :func:`close_session` is called.
+    Cookies set by servers are not kept by the session, so just like requests, each call to the
+    module level functions is independent. Cookies are still followed within a redirect chain.
+    """
+    global _shared_session
+    with _shared_lock:
+        if _shared_session is None:
+            _shared_session = Session(CACHE_LOCATION)
+            _shared_session.cookies.set_policy(_NoCookiesPolicy())
+        return _shared_session
+
+
+def close_session():  # type: () -> None
+    """
+    Close the shared session along with all shared adapters.
+
+    They will be recreated the next time they are needed. Any deferred tasks are run first.
+    This should be called when the application is finished making requests.
+    """
+    global _shared_session
+    run_deferred()
+    with _shared_lock:
+        if _shared_session is not None:
+            _shared_session.close()
+            _shared_session = None
+
+        for adapter in _shared_adapters.values():
+            if DUMP_STATS:
+                try:
+                    adapter.dump_stats()
+                except (EnvironmentError, sqlite3.Error) as e:
+                    logger.debug("Unable to save cache statistics: %s", e)
+            adapter.close()
+        _shared_adapters.clear()
+
+
 @wraps(requests.request, assigned=WRAPPER_ASSIGNMENTS)
 def request(method, url, **kwargs):  # type: (...) -> Response
-    with Session() as s:
-        return s.request(method=method, url=url, **kwargs)
+    return get_session().request(method=method, url=url, **kwargs)
 
 
 @wraps(requests.get, assigned=WRAPPER_ASSIGNMENTS)
@@ -524,6 +2541,22 @@ def delete(url, **kwargs):  # type: (...) -> Response
     return request('delete', url, **kwargs)
 
 
+def fetch_many(urls, method="GET", **kwargs):  # type: (...) -> list
+    """
+    Make multiple requests concurrently using the shared session.
+    See :meth:`Session.fetch_many` for the list of parameters.
+    """
+    return get_session().fetch_many(urls, method, **kwargs)
+
+
+def prefetch(urls, **kwargs):  # type: (...) -> None
+    """
+    Queue urls to be fetched into the cache later, using the shared session.
+    See :meth:`Session.prefetch` for the list of parameters.
+    """
+    get_session().prefetch(urls, **kwargs)
+
+
 @wraps(requests.session, assigned=WRAPPER_ASSIGNMENTS)
 def session():  # type: (...) -> Session
     return Session()
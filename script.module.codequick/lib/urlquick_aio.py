@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2021 William Forde
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Urlquick AIO
+------------
+Asyncio counterpart to :class:`urlquick.Session`, using aiohttp for the network requests.
+
+Responses are cached in the same database as urlquick, using the same cache keys,
+so cached responses are shared between sync and async code. Python 3 only.
+
+The cache database is accessed from the default executor of the event loop,
+so a busy or locked database does not block other tasks.
+"""
+
+# Standard Lib
+from datetime import timedelta
+from urllib.parse import urljoin
+import functools
+import asyncio
+import logging
+import time
+
+# Third Party
+from requests.structures import CaseInsensitiveDict
+from requests.utils import default_headers, get_encoding_from_headers
+from requests.models import Request
+import aiohttp
+
+# Package imports
+from urlquick import Response, TooManyRedirects, CacheStats, CACHE_LOCATION, MAX_AGE, get_adapter, hash_url
+from urlquick import _DEFAULT_RAISE_FOR_STATUS
+
+# Unique logger for this module
+logger = logging.getLogger("urlquick.aio")
+
+#: The maximum number of redirects that will be followed.
+MAX_REDIRECTS = 30
+
+
+class AsyncSession(object):
+    """
+    Asyncio session with support for http caching.
+
+    Just like :class:`urlquick.Session`, the session attaches to the process wide
+    cache adapter for the given cache location, which is only used for its cache database.
+    Must be created and used within a running event loop.
+    """
+
+    def __init__(self, cache_location=CACHE_LOCATION, **kwargs):  # type: (str, ...) -> None
+        #: Raise :class:`HTTPError` if the status code is between 400 and 600.
+        self.raise_for_status = kwargs.get("raise_for_status", _DEFAULT_RAISE_FOR_STATUS)
+
+        #: Age the 'cache' can be, before it’s considered stale. -1 will disable caching.
+        #: Defaults to :data:`MAX_AGE <urlquick.MAX_AGE>`
+        self.max_age = kwargs.get("max_age", MAX_AGE)
+
+        #: Headers that will be sent with every request.
+        self.headers = default_headers()
+
+        #: Normalization rules used to build the cache key of each request, see :class:`urlquick.CacheKey`.
+        self.cache_key = kwargs.get("cache_key")
+
+        #: Statistics of the requests made by this session, see :class:`urlquick.CacheStats`.
+        self.stats = CacheStats()
+
+        # The shared adapter is only fetched on first use, from the executor, as it may setup the database
+        self._cache_adapter = kwargs.get("cache_adapter")
+        self._cache_location = cache_location
+        self._client = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """Close the aiohttp client session. The cache adapter is left open for other sessions."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    @property
+    def cache_adapter(self):  # type: () -> CacheHTTPAdapter
+        """
+        The cache adapter, replaced by the new shared adapter if it was closed by :func:`urlquick.close_session`.
+        Setting up the shared adapter opens the database, so within the event loop use :meth:`_run`.
+        """
+        if self._cache_adapter is None or (self._cache_adapter.shared and self._cache_adapter.closed):
+            self._cache_adapter = get_adapter(self._cache_location)
+        return self._cache_adapter
+
+    @property
+    def client(self):  # type: () -> aiohttp.ClientSession
+        """The aiohttp client session, created on first use."""
+        if self._client is None:
+            # Disable aiohttp's default headers, the headers from requests are used instead
+            self._client = aiohttp.ClientSession(skip_auto_headers=("User-Agent", "Accept-Encoding"))
+        return self._client
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        """Run a blocking function in the default executor, so database access does not block the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    def _merge_max_age(self, max_age):  # type: (int) -> int
+        """Return a valid max age. Use session value if request did not containe one."""
+        return (-1 if self.max_age is None else self.max_age) if max_age is None else max_age
+
+    async def request(self, method, url, params=None, data=None, headers=None, json=None,
+                      allow_redirects=True, timeout=None, max_age=None, raise_for_status=None):
+        """
+        Make a request, checking the cache first.
+
+        :param str method: The http method to use.
+        :param str url: The url of the resource.
+        :param dict params: [opt] Query parameters to add to the url.
+        :param data: [opt] Body of the request.
+        :param dict headers: [opt] Extra headers to send with the request.
+        :param json: [opt] Json serializable object to send as the body of the request.
+        :param bool allow_redirects: [opt] Follow any redirects. (default => True)
+        :param float timeout: [opt] Total time in seconds to wait for each response.
+        :param int max_age: [opt] Age the 'cache' can be, before it’s considered stale. -1 will disable caching.
+        :param bool raise_for_status: [opt] Raise :class:`HTTPError` if status code is between 400 and 600.
+
+        :rtype: urlquick.Response
+        """
+        merged_headers = self.headers.copy()
+        merged_headers.update(headers or {})
+        request = Request(method.upper(), url, merged_headers, params=params, data=data, json=json).prepare()
+        max_age = self._merge_max_age(max_age)
+        history = []
+
+        while True:
+            response = await self._send(request, max_age, timeout)
+            if not (allow_redirects and response.is_redirect):
+                break
+            elif len(history) >= MAX_REDIRECTS:
+                raise TooManyRedirects("Exceeded {} redirects.".format(MAX_REDIRECTS), response=response)
+
+            history.append(response)
+            request = self._redirect_request(request, response)
+
+        response.history = history
+        if self.raise_for_status if raise_for_status is None else raise_for_status:
+            response.raise_for_status()
+        return response
+
+    @staticmethod
+    def _redirect_request(request, response):  # type: (PreparedRequest, Response) -> PreparedRequest
+        """Return a new request for the redirect location."""
+        new_request = request.copy()
+        new_request.prepare_url(urljoin(response.url, response.headers["location"]), None)
+
+        # Conditional headers from the cache only apply to the original url
+        for header in ("If-None-Match", "If-Modified-Since"):
+            new_request.headers.pop(header, None)
+
+        if response.status_code == 303 or (response.status_code in (301, 302) and request.method == "POST"):
+            new_request.method = "GET"
+            new_request.body = None
+            for header in ("Content-Length", "Content-Type", "Transfer-Encoding"):
+                new_request.headers.pop(header, None)
+        return new_request
+
+    async def _send(self, request, max_age, timeout):  # type: (PreparedRequest, int, float) -> Response
+        """Send a single request, using the cache if possible."""
+        request.cache_stats = self.stats
+        key_func = hash_url if self.cache_key is None else self.cache_key
+        urlhash = key_func(request) if max_age >= 0 else None
+        cache = await self._run(self._check_cache, request, urlhash, max_age)
+        if cache and cache.isfresh:
+            return cache.response
+
+        response = await self._fetch(request, timeout)
+        if urlhash:
+            return await self._run(self.cache_adapter.process_response, response, cache, urlhash)
+        return response
+
+    def _check_cache(self, request, urlhash, max_age):  # type: (PreparedRequest, str, int) -> CacheRecord
+        """Return the cache record for the request, setting up the cache adapter if needed."""
+        return self.cache_adapter.check_cache(request, urlhash, max_age)
+
+    async def _fetch(self, request, timeout):  # type: (PreparedRequest, float) -> Response
+        """Send request for remote resource and build a urlquick response."""
+        start_time = time.time()
+        options = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+        async with self.client.request(request.method, request.url, headers=dict(request.headers),
+                                       data=request.body, allow_redirects=False, **options) as resp:
+            self.cache_adapter.time_event(request, "network", time.time() - start_time)
+            content = await resp.read()
+
+        # Duplicate headers are joined together, the same way requests does it
+        headers = CaseInsensitiveDict()
+        for key, value in resp.headers.items():
+            headers[key] = "{}, {}".format(headers[key], value) if key in headers else value
+
+        response = Response()
+        response.status_code = resp.status
+        response.reason = resp.reason
+        response.url = str(resp.url)
+        response.headers = headers
+        response.encoding = get_encoding_from_headers(headers)
+        response.elapsed = timedelta(seconds=time.time() - start_time)
+        response.request = request
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    async def get(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", True)
+        return await self.request("GET", url, **kwargs)
+
+    async def options(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", True)
+        return await self.request("OPTIONS", url, **kwargs)
+
+    async def head(self, url, **kwargs):
+        kwargs.setdefault("allow_redirects", False)
+        return await self.request("HEAD", url, **kwargs)
+
+    async def post(self, url, data=None, json=None, **kwargs):
+        return await self.request("POST", url, data=data, json=json, **kwargs)
+
+    async def put(self, url, data=None, **kwargs):
+        return await self.request("PUT", url, data=data, **kwargs)
+
+    async def patch(self, url, data=None, **kwargs):
+        return await self.request("PATCH", url, data=data, **kwargs)
+
+    async def delete(self, url, **kwargs):
+        return await self.request("DELETE", url, **kwargs)
@@ -20,6 +20,27 @@ def mock_argv(argv):
         sys.argv = org_sys
 
 
+@contextmanager
+def mock_urlquick():
+    """Replace urlquick with a stub module that counts the calls to close_session."""
+    class Urlquick(object):
+        closed = 0
+
+        @classmethod
+        def close_session(cls):
+            cls.closed += 1
+
+    org_module = sys.modules.get("urlquick")
+    sys.modules["urlquick"] = Urlquick
+    try:
+        yield Urlquick
+    finally:
+        if org_module is None:
+            del sys.modules["urlquick"]
+        else:
+            sys.modules["urlquick"] = org_module
+
+
 class TestLogging(unittest.TestCase):
     def test_logger(self):
         support.base_logger.debug("test debug")
@@ -236,6 +257,24 @@ class TestDispatcher(unittest.TestCase):
 
         self.assertTrue(Executed.yes)
 
+    def test_dispatch_close_session(self):
+        def root(_):
+            return False
+
+        self.dispatcher.register_callback(root, script.Script, {})
+        with mock_urlquick() as urlquick:
+            self.dispatcher.run_callback()
+        self.assertEqual(urlquick.closed, 1)
+
+    def test_dispatch_fail_close_session(self):
+        def root(_):
+            raise RuntimeError("testing error")
+
+        self.dispatcher.register_callback(root, route.Route, {})
+        with mock_argv(["plugin://script.module.codequick", 96, ""]), mock_urlquick() as urlquick:
+            self.dispatcher.run_callback()
+        self.assertEqual(urlquick.closed, 1)
+
 
 class BuildPath(unittest.TestCase):
     def setUp(self):
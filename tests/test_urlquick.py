@@ -0,0 +1,1322 @@
+import multiprocessing
+import unittest
+import threading
+import tempfile
+import shutil
+import sqlite3
+import json
+import mmap
+import time
+import os
+
+# Testing specific imports
+import urlquick
+
+try:
+    import urlquick_aio
+    import asyncio
+except (ImportError, SyntaxError):  # pragma: no cover
+    urlquick_aio = None
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    # noinspection PyUnresolvedReferences
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    # noinspection PyUnresolvedReferences
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """Simple request handler that returns the request path as the body."""
+    hits = 0
+    fail = False
+
+    def do_GET(self):
+        RequestHandler.hits += 1
+        if RequestHandler.fail:
+            self.send_error(503)
+            return
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+
+        if "/missing" in self.path:
+            self.send_error(404)
+            return
+        elif self.path.startswith("/redirect"):
+            self.send_response(301)
+            self.send_header("Location", "/target")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if self.path.startswith("/etag") and self.headers.get("If-None-Match") == '"etag"':
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = self.path.encode("utf8")
+        if self.path.startswith("/large"):
+            body = body * (urlquick.FILE_CACHE_THRESHOLD // len(body) + 1)
+        elif self.path.startswith("/vary"):
+            body = "{}:{}".format(self.path, self.headers.get("Accept-Language")).encode("utf8")
+        elif self.path.startswith("/json"):
+            body = json.dumps({"path": self.path, "items": list(range(10))}).encode("utf8")
+        elif self.path.startswith("/compress"):
+            body = body * 1000
+        elif self.path.startswith("/random"):
+            body = os.urandom(urlquick.COMPRESS_THRESHOLD * 2)
+        elif self.path.startswith("/page"):
+            body = b"<html><body><div id='top'>found</div>" + b"<p>filler</p>" * 100000 + b"</body></html>"
+        elif self.path.startswith("/whoami"):
+            body = (self.headers.get("Cookie") or "").encode("utf8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if self.path.startswith("/etag"):
+            self.send_header("ETag", '"etag"')
+        elif self.path.startswith("/max-age"):
+            self.send_header("Cache-Control", "public, max-age=3600")
+        elif self.path.startswith("/no-store"):
+            self.send_header("Cache-Control", "no-store")
+        elif self.path.startswith("/no-cache"):
+            self.send_header("Cache-Control", "no-cache")
+        elif self.path.startswith("/vary-all"):
+            self.send_header("Vary", "*")
+        elif self.path.startswith("/vary"):
+            self.send_header("Vary", "Accept-Language")
+        elif self.path.startswith("/login"):
+            self.send_header("Set-Cookie", "token=secret; Path=/; Max-Age=3600")
+            self.send_header("Set-Cookie", "consent=yes; Path=/")
+        elif self.path.startswith("/logout"):
+            self.send_header("Set-Cookie", "token=; Path=/; Max-Age=0")
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (IOError, OSError):
+            # Client closed the connection early
+            pass
+
+    do_PUT = do_GET
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        pass
+
+
+def age_cache(adapter, seconds):
+    """Make all cached responses older by the given number of seconds."""
+    adapter.execute("UPDATE urlcache SET cached_date = cached_date - ?", (seconds,))
+    adapter.memory_cache.clear()
+
+
+def hammer_cache(cache_location, worker, operations):
+    """Read and write to the cache database, used by the multi process stress test."""
+    adapter = urlquick.CacheHTTPAdapter(cache_location)
+    try:
+        for i in range(operations):
+            if i % 20 == 10:
+                # Open the database again, while the other workers are writing
+                adapter.close()
+                adapter = urlquick.CacheHTTPAdapter(cache_location)
+
+            urlhash = "key-%d" % (i % 20)
+            resp = urlquick.Response()
+            resp.status_code = 200
+            resp.reason = "OK"
+            resp.url = "http://127.0.0.1/%s" % urlhash
+            resp.headers = urlquick.CaseInsensitiveDict({"Content-Type": "text/plain"})
+            resp._content = ("%s-%d" % (urlhash, worker)).encode("ascii") * 100
+            adapter.set_cache(urlhash, resp)
+
+            adapter.memory_cache.clear()
+            cached = adapter.load_response(urlhash)
+            assert cached is None or cached.content.startswith(urlhash.encode("ascii"))
+            if i % 25 == 0:
+                adapter.clean()
+    finally:
+        adapter.close()
+
+
+def dump_stats(path, operations):
+    """Dump statistics to the same file as the other workers, used by the multi process stats test."""
+    stats = urlquick.CacheStats()
+    for _ in range(operations):
+        stats.count("example.com", "fresh")
+        stats.dump(path)
+
+
+class LocalServer(unittest.TestCase):
+    """Base testcase that serves requests from a local http server."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedServer(("127.0.0.1", 0), RequestHandler)
+        cls.url = "http://127.0.0.1:%d" % cls.server.server_port
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_location = tempfile.mkdtemp()
+        RequestHandler.hits = 0
+        RequestHandler.fail = False
+
+    def tearDown(self):
+        urlquick.close_session()
+        shutil.rmtree(self.cache_location, ignore_errors=True)
+
+
+class SharedSession(LocalServer):
+    def setUp(self):
+        super(SharedSession, self).setUp()
+        # Keep the shared session out of the default cache location
+        self.default_location, urlquick.CACHE_LOCATION = urlquick.CACHE_LOCATION, self.cache_location
+
+    def tearDown(self):
+        urlquick.CACHE_LOCATION = self.default_location
+        super(SharedSession, self).tearDown()
+
+    def test_get_session(self):
+        self.assertIs(urlquick.get_session(), urlquick.get_session())
+
+    def test_get_adapter(self):
+        adapter = urlquick.get_adapter(self.cache_location)
+        self.assertIs(adapter, urlquick.get_adapter(self.cache_location))
+        self.assertTrue(adapter.shared)
+
+    def test_session_uses_shared_adapter(self):
+        with urlquick.Session(self.cache_location) as session:
+            adapter = session.cache_adapter
+            self.assertIs(adapter, urlquick.get_adapter(self.cache_location))
+
+        # Closing the session must not close the shared adapter
+        self.assertFalse(adapter.closed)
+
+    def test_custom_adapter(self):
+        adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+        with urlquick.Session(self.cache_location, cache_adapter=adapter) as session:
+            self.assertIs(session.cache_adapter, adapter)
+        self.assertTrue(adapter.closed)
+
+    def test_close_session(self):
+        session = urlquick.get_session()
+        adapter = urlquick.get_adapter(self.cache_location)
+        urlquick.close_session()
+        self.assertTrue(adapter.closed)
+        self.assertIsNot(session, urlquick.get_session())
+        self.assertIsNot(adapter, urlquick.get_adapter(self.cache_location))
+
+    def test_stateless_cookies(self):
+        urlquick.get(self.url + "/login", max_age=-1)
+        self.assertEqual(urlquick.get(self.url + "/whoami", max_age=-1).text, u"")
+        self.assertEqual(len(urlquick.get_session().cookies), 0)
+
+    def test_session_outlives_close_session(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/before")
+            adapter = session.cache_adapter
+            urlquick.close_session()
+            self.assertTrue(adapter.closed)
+
+            self.assertEqual(session.get(self.url + "/after").text, u"/after")
+            self.assertIsNot(session.cache_adapter, adapter)
+            self.assertFalse(session.cache_adapter.closed)
+            self.assertTrue(session.get(self.url + "/before").from_cache)
+
+    def test_cached_request(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/cached")
+            self.assertEqual(resp.text, u"/cached")
+            self.assertFalse(resp.from_cache)
+
+            resp = session.get(self.url + "/cached")
+            self.assertEqual(resp.text, u"/cached")
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(RequestHandler.hits, 1)
+
+
+class CacheFormat(LocalServer):
+    def test_split_columns(self):
+        with urlquick.Session(self.cache_location) as session:
+            org = session.get(self.url + "/format")
+            record = session.cache_adapter.execute("SELECT * FROM urlcache").fetchone()
+            self.assertEqual(record["status"], 200)
+            self.assertEqual(record["url"], org.url)
+            self.assertEqual(bytes(record["content"]), b"/format")
+
+            resp = session.get(self.url + "/format")
+            self.assertTrue(resp.from_cache)
+            self.assertIs(resp.request.__class__, urlquick.PreparedRequest)
+            self.assertEqual(resp.status_code, org.status_code)
+            self.assertEqual(resp.reason, org.reason)
+            self.assertEqual(resp.encoding, org.encoding)
+            self.assertEqual(resp.headers["content-type"], org.headers["Content-Type"])
+            self.assertEqual(resp.content, org.content)
+
+
+class CacheCleanup(LocalServer):
+    def setUp(self):
+        super(CacheCleanup, self).setUp()
+        self.adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+
+    def tearDown(self):
+        self.adapter.close()
+        super(CacheCleanup, self).tearDown()
+
+    def insert(self, key, cached_date):
+        self.adapter.execute("""INSERT INTO urlcache (key, status, url, reason, encoding, headers, content,
+        cached_date) VALUES (?, 200, 'http://127.0.0.1/', 'OK', NULL, '{}', x'00', ?)""", (key, cached_date))
+
+    def test_clean_expired(self):
+        self.insert("old", 0)
+        self.insert("new", int(time.time()))
+        self.adapter.clean()
+        keys = [row["key"] for row in self.adapter.execute("SELECT key FROM urlcache")]
+        self.assertEqual(keys, ["new"])
+
+    def test_auto_clean_skipped(self):
+        # Adapter already cleaned the database when it was created
+        self.assertFalse(self.adapter.auto_clean())
+
+    def test_auto_clean_due(self):
+        self.adapter.execute("UPDATE urlmeta SET value = 0 WHERE name = 'last_clean'")
+        self.assertTrue(self.adapter.auto_clean())
+        self.assertFalse(self.adapter.auto_clean())
+
+    def test_schema_upgrade(self):
+        self.adapter.execute("PRAGMA user_version=1")
+        self.adapter.close()
+        self.adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+        version = self.adapter.execute("PRAGMA user_version").fetchone()[0]
+        self.assertEqual(version, urlquick._SCHEMA_VERSION)
+
+
+class LazyRecord(LocalServer):
+    def test_body_not_loaded(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/lazy")
+            record = session.cache_adapter.get_cache(urlquick.hash_url(resp.request), 60)
+            self.assertIsNone(record._response)
+            self.assertTrue(record.isfresh)
+            self.assertEqual(record.response.content, b"/lazy")
+
+            # Stale records should not load the body
+            record = session.cache_adapter.get_cache(urlquick.hash_url(resp.request), 0)
+            self.assertFalse(record.isfresh)
+            self.assertIsNone(record._response)
+
+    def test_not_modified(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/etag")
+            resp = session.get(self.url + "/etag", max_age=0)
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content, b"/etag")
+            self.assertEqual(RequestHandler.hits, 2)
+
+
+class FetchMany(LocalServer):
+    def test_ordered(self):
+        urls = [self.url + "/slow/%d" % i for i in range(6)]
+        start = time.time()
+        with urlquick.Session(self.cache_location) as session:
+            responses = session.fetch_many(urls, max_workers=6)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual([resp.text for resp in responses], ["/slow/%d" % i for i in range(6)])
+
+    def test_as_completed(self):
+        urls = [self.url + "/%d" % i for i in range(4)]
+        with urlquick.Session(self.cache_location) as session:
+            results = dict(session.fetch_many(urls, as_completed=True))
+        self.assertEqual(sorted(results), urls)
+        self.assertTrue(all(results[url].url == url for url in urls))
+
+    def test_request_kwargs(self):
+        items = [{"url": self.url + "/kwargs", "params": {"a": "1"}}, self.url + "/plain"]
+        with urlquick.Session(self.cache_location) as session:
+            responses = session.fetch_many(items)
+        self.assertEqual(responses[0].text, "/kwargs?a=1")
+        self.assertEqual(responses[1].text, "/plain")
+
+    def test_shared_cache(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.fetch_many([self.url + "/shared"] * 3, max_workers=1)
+        self.assertEqual(RequestHandler.hits, 1)
+
+    def test_error(self):
+        urls = [self.url + "/ok", self.url + "/missing"]
+        with urlquick.Session(self.cache_location, raise_for_status=True) as session:
+            with self.assertRaises(urlquick.HTTPError):
+                session.fetch_many(urls)
+
+    def test_pool_size(self):
+        adapter = urlquick.get_adapter(self.cache_location)
+        self.assertEqual(adapter._pool_maxsize, urlquick.MAX_WORKERS)
+        self.assertEqual(adapter.poolmanager.connection_pool_kw["maxsize"], urlquick.MAX_WORKERS)
+
+
+@unittest.skipIf(urlquick_aio is None, "aiohttp is not available")
+class AsyncSession(LocalServer):
+    def run_session(self, method, url, **kwargs):
+        async def run():
+            async with urlquick_aio.AsyncSession(self.cache_location) as session:
+                return await getattr(session, method)(url, **kwargs)
+        return asyncio.run(run())
+
+    def test_get(self):
+        resp = self.run_session("get", self.url + "/async")
+        self.assertEqual(resp.text, u"/async")
+        self.assertFalse(resp.from_cache)
+
+    def test_shared_cache(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/async")
+
+        resp = self.run_session("get", self.url + "/async")
+        self.assertTrue(resp.from_cache)
+        self.assertEqual(resp.text, u"/async")
+        self.assertEqual(RequestHandler.hits, 1)
+
+        self.run_session("get", self.url + "/async2")
+        with urlquick.Session(self.cache_location) as session:
+            self.assertTrue(session.get(self.url + "/async2").from_cache)
+
+    def test_not_modified(self):
+        self.run_session("get", self.url + "/etag")
+        resp = self.run_session("get", self.url + "/etag", max_age=0)
+        self.assertTrue(resp.from_cache)
+        self.assertEqual(resp.content, b"/etag")
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_redirect(self):
+        resp = self.run_session("get", self.url + "/redirect")
+        self.assertEqual(resp.text, u"/target")
+        self.assertEqual(len(resp.history), 1)
+        self.assertEqual(resp.history[0].status_code, 301)
+
+    def test_raise_for_status(self):
+        with self.assertRaises(urlquick.HTTPError):
+            self.run_session("get", self.url + "/missing", raise_for_status=True)
+
+    def test_cache_off_loop(self):
+        adapter = urlquick.get_adapter(self.cache_location)
+        check_cache, process_response = adapter.check_cache, adapter.process_response
+        threads = []
+
+        def record(func):
+            def wrapper(*args, **kwargs):
+                threads.append(threading.current_thread())
+                return func(*args, **kwargs)
+            return wrapper
+
+        adapter.check_cache, adapter.process_response = record(check_cache), record(process_response)
+        try:
+            self.run_session("get", self.url + "/async")
+        finally:
+            adapter.check_cache, adapter.process_response = check_cache, process_response
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+
+
+class StaleWhileRevalidate(LocalServer):
+    def test_stale_response(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/swr")
+            resp = session.get(self.url + "/swr", max_age=0, stale_while_revalidate=60)
+            self.assertTrue(resp.from_cache)
+            self.assertTrue(resp.is_stale)
+            self.assertEqual(RequestHandler.hits, 1)
+
+            # Revalidation only happens when deferred tasks are run
+            urlquick.run_deferred()
+            self.assertEqual(RequestHandler.hits, 2)
+            resp = session.get(self.url + "/swr", max_age=60)
+            self.assertFalse(resp.is_stale)
+            self.assertEqual(RequestHandler.hits, 2)
+
+    def test_revalidate_once(self):
+        with urlquick.Session(self.cache_location, stale_while_revalidate=60) as session:
+            session.get(self.url + "/swr")
+            session.get(self.url + "/swr", max_age=0)
+            session.get(self.url + "/swr", max_age=0)
+
+        urlquick.close_session()
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_outside_window(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/swr")
+            age_cache(session.cache_adapter, 120)
+            resp = session.get(self.url + "/swr", max_age=30, stale_while_revalidate=60)
+            self.assertFalse(resp.from_cache)
+            self.assertEqual(RequestHandler.hits, 2)
+
+
+class CacheControl(LocalServer):
+    def test_server_lifetime(self):
+        headers = urlquick.CaseInsensitiveDict({"Cache-Control": "max-age=600", "Age": "100"})
+        self.assertEqual(urlquick.server_lifetime(headers), 500)
+
+        headers = urlquick.CaseInsensitiveDict({"Date": "Thu, 01 Jan 2015 00:00:00 GMT",
+                                                "Expires": "Thu, 01 Jan 2015 01:00:00 GMT"})
+        now = urlquick.parse_http_date(headers["Date"])
+        self.assertEqual(urlquick.server_lifetime(headers, now), 3600)
+
+        headers = urlquick.CaseInsensitiveDict({"Expires": "0"})
+        self.assertEqual(urlquick.server_lifetime(headers), -1)
+        self.assertIsNone(urlquick.server_lifetime(urlquick.CaseInsensitiveDict()))
+
+    def test_freshness_lifetime(self):
+        lifetime = urlquick.CacheRecord.freshness_lifetime
+        self.assertEqual(lifetime(3600, 60, None), 60)
+        self.assertEqual(lifetime(3600, 60, "server"), 3600)
+        self.assertEqual(lifetime(None, 60, "server"), 60)
+        self.assertEqual(lifetime(3600, 60, "upper"), 60)
+        self.assertEqual(lifetime(3600, 60, "lower"), 3600)
+        self.assertEqual(lifetime(-1, 60, "lower"), 0)
+
+    def test_max_age_extended(self):
+        with urlquick.Session(self.cache_location, cache_control=True) as session:
+            session.get(self.url + "/max-age")
+            age_cache(session.cache_adapter, 120)
+            resp = session.get(self.url + "/max-age", max_age=60)
+            self.assertTrue(resp.from_cache)
+
+            # Without cache control the client max age is used
+            resp = session.get(self.url + "/max-age", max_age=60, cache_control=False)
+            self.assertFalse(resp.from_cache)
+
+    def test_no_store(self):
+        with urlquick.Session(self.cache_location, cache_control="lower") as session:
+            session.get(self.url + "/no-store")
+            resp = session.get(self.url + "/no-store")
+            self.assertFalse(resp.from_cache)
+            self.assertEqual(RequestHandler.hits, 2)
+
+    def test_no_cache(self):
+        with urlquick.Session(self.cache_location, cache_control="lower") as session:
+            session.get(self.url + "/no-cache")
+            resp = session.get(self.url + "/no-cache")
+            self.assertFalse(resp.from_cache)
+
+    def test_invalid_mode(self):
+        with urlquick.Session(self.cache_location, cache_control="invalid") as session:
+            with self.assertRaises(ValueError):
+                session.get(self.url + "/max-age")
+
+
+class MemoryCache(LocalServer):
+    def test_memory_hit(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/memory")
+            adapter = session.cache_adapter
+            self.assertEqual(len(adapter.memory_cache), 1)
+
+            # Memory cache should be used even when the database row is gone
+            adapter.execute("DELETE FROM urlcache")
+            resp = session.get(self.url + "/memory")
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(resp.content, b"/memory")
+            self.assertEqual(RequestHandler.hits, 1)
+
+    def test_filled_from_database(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/memory")
+            session.cache_adapter.memory_cache.clear()
+            self.assertTrue(session.get(self.url + "/memory").from_cache)
+            self.assertEqual(len(session.cache_adapter.memory_cache), 1)
+
+    def test_separate_copies(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/memory")
+            first = session.get(self.url + "/memory")
+            first.headers["x-changed"] = "true"
+            second = session.get(self.url + "/memory")
+            self.assertIsNot(first, second)
+            self.assertNotIn("x-changed", second.headers)
+
+    def test_invalidation(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/memory")
+            adapter = session.cache_adapter
+            adapter.del_cache(urlquick.hash_url(resp.request))
+            self.assertEqual(len(adapter.memory_cache), 0)
+            self.assertFalse(session.get(self.url + "/memory").from_cache)
+
+    def test_lru_limits(self):
+        memory = urlquick.MemoryCache(max_entries=2, max_size=10)
+        for key, body in (("a", b"1234"), ("b", b"1234"), ("c", b"1234")):
+            resp = urlquick.Response()
+            resp._content = body
+            memory.set(key, {"cached_date": 0}, resp)
+        self.assertIsNone(memory.get("a"))
+        self.assertEqual(len(memory), 2)
+        self.assertEqual(memory.size, 8)
+
+        # Touching "b" makes "c" the least recently used
+        memory.get("b")
+        resp = urlquick.Response()
+        resp._content = b"123456"
+        memory.set("d", {"cached_date": 0}, resp)
+        self.assertIsNone(memory.get("c"))
+        self.assertIsNotNone(memory.get("b"))
+        self.assertEqual(memory.size, 10)
+
+
+class FileCache(LocalServer):
+    def test_large_body(self):
+        with urlquick.Session(self.cache_location) as session:
+            org = session.get(self.url + "/large")
+            urlhash = urlquick.hash_url(org.request)
+            self.assertTrue(os.path.exists(session.cache_adapter.body_file(urlhash)))
+
+            resp = session.get(self.url + "/large")
+            self.assertTrue(resp.from_cache)
+            self.assertIsInstance(resp.raw, mmap.mmap)
+            self.assertEqual(resp.content, org.content)
+            self.assertEqual(len(session.cache_adapter.memory_cache), 0)
+
+            session.cache_adapter.del_cache(urlhash)
+            self.assertFalse(os.path.exists(session.cache_adapter.body_file(urlhash)))
+
+    def test_mapped_body_closed(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/large")
+            resp = session.get(self.url + "/large")
+            self.assertTrue(resp.content)
+            self.assertTrue(resp.raw.closed)
+
+    def test_body_file_in_use(self):
+        with urlquick.Session(self.cache_location) as session:
+            request = session.prepare_request(urlquick.Request("GET", self.url + "/large"))
+            # A destination that can't be replaced, like a file that is still mapped on windows
+            body_file = session.cache_adapter.body_file(urlquick.hash_url(request))
+            os.makedirs(os.path.join(body_file, "in-use"))
+
+            self.assertEqual(session.get(self.url + "/large").status_code, 200)
+            self.assertFalse(session.get(self.url + "/large").from_cache)
+            self.assertEqual(RequestHandler.hits, 2)
+
+    def test_streamed(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/large-stream", stream=True)
+            body = b"".join(resp.iter_content(1024))
+            resp = session.get(self.url + "/large-stream", stream=True)
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(b"".join(resp.iter_content(1024)), body)
+            self.assertEqual(RequestHandler.hits, 1)
+
+    def test_orphaned_files(self):
+        with urlquick.Session(self.cache_location) as session:
+            adapter = session.cache_adapter
+            resp = session.get(self.url + "/large-dropped", stream=True)
+            next(resp.iter_content(1024))
+            del resp
+
+            session.get(self.url + "/large")
+            orphan = adapter.body_file("orphan")
+            with open(orphan, "wb") as stream:
+                stream.write(b"orphan")
+
+            files = os.listdir(adapter.files_dir)
+            self.assertEqual(len(files), 3)
+            self.assertEqual(adapter.clean_files(time.time() - 60), 0)
+            self.assertEqual(adapter.clean_files(time.time() + 1), 2)
+            self.assertEqual(os.listdir(adapter.files_dir), [session.get(self.url + "/large").urlhash])
+
+    def test_streamed_small(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/small-stream", stream=True)
+            self.assertEqual(resp.content, b"/small-stream")
+            resp = session.get(self.url + "/small-stream")
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(resp.content, b"/small-stream")
+            self.assertEqual(os.listdir(session.cache_adapter.files_dir), [])
+
+    def test_streamed_partial(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/large-partial", stream=True)
+            next(resp.iter_content(1024))
+            resp.close()
+
+            self.assertFalse(session.get(self.url + "/large-partial").from_cache)
+            self.assertEqual(RequestHandler.hits, 2)
+
+
+class CacheEviction(LocalServer):
+    def setUp(self):
+        super(CacheEviction, self).setUp()
+        self.adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+
+    def tearDown(self):
+        self.adapter.close()
+        super(CacheEviction, self).tearDown()
+
+    def insert(self, key, size, last_access):
+        self.adapter.execute("""INSERT INTO urlcache (key, status, url, reason, encoding, headers, content,
+        size, last_access, cached_date) VALUES (?, 200, 'http://127.0.0.1/', 'OK', NULL, '{}', x'00', ?, ?, ?)""",
+                             (key, size, last_access, int(time.time())))
+
+    def keys(self):
+        return sorted(row["key"] for row in self.adapter.execute("SELECT key FROM urlcache"))
+
+    def test_under_limit(self):
+        self.insert("a", 100, 1)
+        self.insert("b", 100, 2)
+        self.assertEqual(self.adapter.evict(200), 0)
+        self.assertEqual(self.keys(), ["a", "b"])
+
+    def test_least_recently_used(self):
+        self.insert("cold", 100, 1)
+        self.insert("hot", 100, 3)
+        self.insert("warm", 100, 2)
+        self.assertEqual(self.adapter.evict(250), 1)
+        self.assertEqual(self.keys(), ["hot", "warm"])
+
+    def test_evicts_to_ninety_percent(self):
+        for i in range(10):
+            self.insert(str(i), 10, i)
+        self.assertEqual(self.adapter.evict(95), 2)
+        self.assertEqual(self.keys(), [str(i) for i in range(2, 10)])
+
+    def test_access_keeps_entry(self):
+        with urlquick.Session(self.cache_location, cache_adapter=self.adapter) as session:
+            session.get(self.url + "/cold")
+            session.get(self.url + "/hot")
+            self.adapter.execute("UPDATE urlcache SET last_access = 0")
+            self.adapter.memory_cache.clear()
+            session.get(self.url + "/hot")
+
+            size = self.adapter.execute("SELECT SUM(size) FROM urlcache").fetchone()[0]
+            self.assertEqual(self.adapter.evict(size - 1), 1)
+            self.assertTrue(session.get(self.url + "/hot").from_cache)
+            self.assertFalse(session.get(self.url + "/cold").from_cache)
+
+
+class MultiProcess(unittest.TestCase):
+    def setUp(self):
+        self.cache_location = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_location, ignore_errors=True)
+
+    def test_wal_mode(self):
+        adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+        try:
+            self.assertEqual(adapter.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        finally:
+            adapter.close()
+
+    def test_corrupted_database(self):
+        with open(os.path.join(self.cache_location, ".urlquick.slite3"), "wb") as stream:
+            stream.write(b"not a database" * 100)
+
+        adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+        try:
+            self.assertEqual(adapter.execute("SELECT COUNT(*) FROM urlcache").fetchone()[0], 0)
+        finally:
+            adapter.close()
+
+    def test_locked_setup(self):
+        # Another process holds the write lock while the schema needs to be created
+        path = os.path.join(self.cache_location, ".urlquick.slite3")
+        holder = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        holder.execute("PRAGMA journal_mode=WAL")
+        holder.execute("PRAGMA user_version=5")
+        holder.execute("BEGIN IMMEDIATE")
+        timer = threading.Timer(0.2, holder.execute, ("ROLLBACK",))
+        timer.start()
+
+        busy_timeout, urlquick.BUSY_TIMEOUT = urlquick.BUSY_TIMEOUT, 0.05
+        try:
+            adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+            self.assertEqual(adapter.execute("PRAGMA user_version").fetchone()[0], urlquick._SCHEMA_VERSION)
+            adapter.close()
+        finally:
+            urlquick.BUSY_TIMEOUT = busy_timeout
+            timer.join()
+            holder.close()
+
+    def test_stress(self):
+        # The workers create the database together, and keep opening it while the others write
+        workers = [multiprocessing.Process(target=hammer_cache, args=(self.cache_location, i, 100))
+                   for i in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        self.assertEqual([worker.exitcode for worker in workers], [0] * len(workers))
+
+        adapter = urlquick.CacheHTTPAdapter(self.cache_location)
+        try:
+            self.assertEqual(adapter.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+            self.assertEqual(adapter.execute("SELECT COUNT(*) FROM urlcache").fetchone()[0], 20)
+        finally:
+            adapter.close()
+
+    def test_stats_dump(self):
+        path = os.path.join(self.cache_location, "stats.json")
+        workers = [multiprocessing.Process(target=dump_stats, args=(path, 50)) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(60)
+        self.assertEqual([worker.exitcode for worker in workers], [0] * len(workers))
+
+        with open(path) as stream:
+            self.assertEqual(json.load(stream)["example.com"]["counters"]["fresh"], 200)
+
+
+class InFlight(LocalServer):
+    def test_coalesced(self):
+        with urlquick.Session(self.cache_location) as session:
+            responses = session.fetch_many([self.url + "/slow/config"] * 5, max_workers=5)
+        self.assertEqual([resp.text for resp in responses], ["/slow/config"] * 5)
+        self.assertEqual(RequestHandler.hits, 1)
+        self.assertEqual(sum(resp.from_cache for resp in responses), 4)
+
+    def test_uncacheable(self):
+        # Waiting requests go to the network when the response could not be cached
+        with urlquick.Session(self.cache_location) as session:
+            responses = session.fetch_many([self.url + "/slow/missing"] * 3, max_workers=3)
+            self.assertEqual([resp.status_code for resp in responses], [404] * 3)
+            self.assertEqual(RequestHandler.hits, 3)
+            self.assertEqual(session.cache_adapter._inflight, {})
+
+
+class StreamParse(LocalServer):
+    def test_early_termination(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/page", stream=True)
+            elem = resp.parse("div", attrs={"id": "top"})
+            self.assertEqual(elem.text, "found")
+            self.assertLess(resp.raw.tell(), int(resp.headers["Content-Length"]))
+
+            # Truncated body is not cached
+            self.assertFalse(session.get(self.url + "/page").from_cache)
+            self.assertEqual(RequestHandler.hits, 2)
+
+    def test_full_body(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/page", stream=True)
+            self.assertEqual(len(resp.parse().findall(".//p")), 100000)
+            self.assertTrue(session.get(self.url + "/page").from_cache)
+
+    def test_consumed(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/page")
+            self.assertEqual(resp.parse("div", attrs={"id": "top"}).text, "found")
+
+    def test_unknown_encoding(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/page", stream=True)
+            resp.encoding = "bogus"
+            self.assertEqual(resp.parse("div", attrs={"id": "top"}).text, "found")
+
+    def test_no_encoding(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/page", stream=True)
+            resp.encoding = None
+            self.assertEqual(resp.parse("div", attrs={"id": "top"}).text, "found")
+
+
+def extract_title(response):
+    extract_title.calls += 1
+    return {"title": response.parse("div", attrs={"id": "top"}).text}
+
+
+class Extracted(LocalServer):
+    def setUp(self):
+        super(Extracted, self).setUp()
+        extract_title.calls = 0
+
+    def test_cached(self):
+        with urlquick.Session(self.cache_location) as session:
+            self.assertEqual(session.get_extracted(self.url + "/page", extract_title), {"title": "found"})
+            self.assertEqual(session.get_extracted(self.url + "/page", extract_title), {"title": "found"})
+        self.assertEqual(extract_title.calls, 1)
+        self.assertEqual(RequestHandler.hits, 1)
+
+    def test_not_modified(self):
+        def extract_length(response):
+            calls.append(response.from_cache)
+            return len(response.text)
+
+        calls = []
+        with urlquick.Session(self.cache_location) as session:
+            session.get_extracted(self.url + "/etag", extract_length)
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            self.assertEqual(session.get_extracted(self.url + "/etag", extract_length), 5)
+        self.assertEqual(calls, [False])
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_version(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get_extracted(self.url + "/page", extract_title)
+            session.get_extracted(self.url + "/page", extract_title, version=1)
+        self.assertEqual(extract_title.calls, 2)
+
+    def test_new_body(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get_extracted(self.url + "/page", extract_title)
+            session.get_extracted(self.url + "/page", extract_title, max_age=0)
+            self.assertEqual(session.cache_adapter.execute("SELECT COUNT(*) FROM urlextract").fetchone()[0], 1)
+        self.assertEqual(extract_title.calls, 2)
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_removed_with_cache(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get_extracted(self.url + "/page", extract_title)
+            session.cache_adapter.wipe()
+            self.assertEqual(session.cache_adapter.execute("SELECT COUNT(*) FROM urlextract").fetchone()[0], 0)
+
+
+    def test_error_not_stored(self):
+        def extract_status(response):
+            return response.status_code
+
+        with urlquick.Session(self.cache_location, stale_while_revalidate=60) as session:
+            session.get_extracted(self.url + "/page", extract_status)
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            RequestHandler.fail = True
+            self.assertEqual(session.get_extracted(self.url + "/page", extract_status, max_age=0,
+                                                   raise_for_status=False), 503)
+            self.assertEqual(session.get_extracted(self.url + "/page", extract_status), 200)
+
+
+class JsonDecode(LocalServer):
+    def test_memoized(self):
+        with urlquick.Session(self.cache_location) as session:
+            resp = session.get(self.url + "/json")
+            self.assertEqual(resp.json()["path"], "/json")
+            self.assertIs(resp.json(), resp.json())
+            self.assertIsNot(resp.json(parse_int=str), resp.json())
+
+    def test_invalid(self):
+        with urlquick.Session(self.cache_location) as session:
+            with self.assertRaises(ValueError):
+                session.get(self.url + "/plain").json()
+
+    def test_persisted(self):
+        with urlquick.Session(self.cache_location) as session:
+            data = session.get_json(self.url + "/json")
+            self.assertEqual(data["items"], list(range(10)))
+            self.assertEqual(session.get_json(self.url + "/json"), data)
+
+            urlhash = urlquick.hash_url(session.get(self.url + "/json").request)
+            self.assertEqual(session.cache_adapter.get_extracted(urlhash, "urlquick.decode_json:0"), data)
+        self.assertEqual(RequestHandler.hits, 1)
+
+
+class CacheKeyRules(LocalServer):
+    def key(self, url, method="GET", **kwargs):
+        rules = urlquick.CacheKey(**kwargs)
+        return rules(urlquick.Request(method, url).prepare())
+
+    def test_default(self):
+        req = urlquick.Request("POST", "http://example.com/path?b=2&a=1", data={"a": "1"}).prepare()
+        self.assertEqual(urlquick.CacheKey()(req), urlquick.hash_url(req))
+
+    def test_sort_query(self):
+        self.assertEqual(self.key("http://example.com/?b=2&a=1", sort_query=True),
+                         self.key("http://example.com/?a=1&b=2", sort_query=True))
+        self.assertNotEqual(self.key("http://example.com/?b=2&a=1"), self.key("http://example.com/?a=1&b=2"))
+
+    def test_drop_params(self):
+        self.assertEqual(self.key("http://example.com/?a=1&_=123&utm_source=x", drop_params=["_", "utm_*"]),
+                         self.key("http://example.com/?a=1"))
+
+    def test_host_aliases(self):
+        aliases = {"M.Example.com": "www.example.com"}
+        self.assertEqual(self.key("http://m.example.com/", host_aliases=aliases),
+                         self.key("http://www.example.com/"))
+
+    def test_per_host(self):
+        hosts = {"api.example.com": urlquick.CacheKey(drop_params=["key"])}
+        self.assertEqual(self.key("http://api.example.com/?key=1", hosts=hosts),
+                         self.key("http://api.example.com/"))
+        self.assertNotEqual(self.key("http://example.com/?key=1", hosts=hosts), self.key("http://example.com/"))
+
+    def test_body(self):
+        rules = urlquick.CacheKey(drop_body_params=["token"])
+        first = urlquick.Request("POST", "http://example.com/", json={"q": "a", "token": "1"}).prepare()
+        second = urlquick.Request("POST", "http://example.com/", json={"token": "2", "q": "a"}).prepare()
+        self.assertEqual(rules(first), rules(second))
+
+        first = urlquick.Request("POST", "http://example.com/", data={"q": "a", "token": "1"}).prepare()
+        second = urlquick.Request("POST", "http://example.com/", data={"q": "a", "token": "2"}).prepare()
+        self.assertEqual(rules(first), rules(second))
+        self.assertEqual(urlquick.CacheKey(ignore_body=True)(first), self.key("http://example.com/", "POST"))
+
+    def test_session(self):
+        rules = urlquick.CacheKey(sort_query=True, drop_params=["_"])
+        with urlquick.Session(self.cache_location, cache_key=rules) as session:
+            session.get(self.url + "/rules?b=2&a=1&_=1")
+            resp = session.get(self.url + "/rules?a=1&b=2&_=2")
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(resp.text, "/rules?b=2&a=1&_=1")
+        self.assertEqual(RequestHandler.hits, 1)
+
+
+class VaryCache(LocalServer):
+    def test_variants(self):
+        with urlquick.Session(self.cache_location) as session:
+            for lang in ("en", "fr", "en", "fr"):
+                resp = session.get(self.url + "/vary", headers={"Accept-Language": lang})
+                self.assertEqual(resp.text, "/vary:" + lang)
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(session.get(self.url + "/vary").text, "/vary:None")
+        self.assertEqual(RequestHandler.hits, 3)
+
+    def test_whitespace(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/vary", headers={"Accept-Language": "en,  fr"})
+            resp = session.get(self.url + "/vary", headers={"Accept-Language": "en, fr"})
+            self.assertTrue(resp.from_cache)
+
+    def test_vary_all(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/vary-all")
+            self.assertFalse(session.get(self.url + "/vary-all").from_cache)
+        self.assertEqual(RequestHandler.hits, 2)
+
+
+    def test_no_queries_for_memory_hits(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/vary")
+            queries = []
+            session.cache_adapter.conn.set_trace_callback(queries.append)
+            for _ in range(5):
+                self.assertTrue(session.get(self.url + "/vary").from_cache)
+            self.assertEqual(queries, [])
+
+    def test_names_written_once(self):
+        with urlquick.Session(self.cache_location, max_age=0) as session:
+            queries = []
+            session.cache_adapter.conn.set_trace_callback(queries.append)
+            for _ in range(3):
+                session.get(self.url + "/vary")
+            self.assertEqual(len([query for query in queries if "INTO urlvary" in query]), 1)
+
+
+class Prefetch(LocalServer):
+    def test_deferred(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.prefetch([self.url + "/next/1", self.url + "/next/2"])
+            self.assertEqual(RequestHandler.hits, 0)
+            urlquick.run_deferred()
+            self.assertEqual(RequestHandler.hits, 2)
+            self.assertTrue(session.get(self.url + "/next/1").from_cache)
+
+    def test_skip_fresh(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/next/1")
+            session.prefetch([self.url + "/next/1", self.url + "/next/2", self.url + "/next/2"])
+            urlquick.run_deferred()
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_byte_budget(self):
+        urls = [self.url + "/next/%d" % i for i in range(5)]
+        with urlquick.Session(self.cache_location) as session:
+            session.prefetch(urls, max_workers=1, max_bytes=10)
+            urlquick.run_deferred()
+        self.assertEqual(RequestHandler.hits, 2)
+
+    def test_errors_ignored(self):
+        with urlquick.Session(self.cache_location, raise_for_status=True) as session:
+            session.prefetch(["http://127.0.0.1:1/refused", self.url + "/missing", self.url + "/next"])
+            urlquick.run_deferred()
+            self.assertTrue(session.get(self.url + "/next").from_cache)
+
+    def test_raise_for_status_kwarg(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.prefetch([self.url + "/missing", self.url + "/next"], raise_for_status=True)
+            urlquick.run_deferred()
+            self.assertEqual(RequestHandler.hits, 2)
+            self.assertTrue(session.get(self.url + "/next").from_cache)
+
+    def test_background_fallback(self):
+        timeout, urlquick.DEFERRED_TIMEOUT = urlquick.DEFERRED_TIMEOUT, 0.1
+        # Start a new worker, one left over from another test would still be sleeping the old timeout
+        urlquick._deferred_thread = None
+        try:
+            with urlquick.Session(self.cache_location) as session:
+                session.prefetch([self.url + "/next"])
+                for _ in range(50):
+                    if RequestHandler.hits:
+                        break
+                    time.sleep(0.1)
+            self.assertEqual(RequestHandler.hits, 1)
+            self.assertFalse(urlquick._deferred)
+        finally:
+            urlquick.DEFERRED_TIMEOUT = timeout
+
+
+class Stats(LocalServer):
+    def test_counters(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/stats")
+            session.get(self.url + "/stats")
+            session.get(self.url + "/etag")
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            session.get(self.url + "/etag")
+
+            counters = session.stats.snapshot()["127.0.0.1"]["counters"]
+            self.assertEqual(counters["fresh"], 1)
+            self.assertEqual(counters["miss"], 2)
+            self.assertEqual(counters["store"], 2)
+            self.assertEqual(counters["revalidated"], 1)
+            self.assertEqual(counters["bytes_cached"], len("/stats") + len("/etag"))
+            self.assertEqual(session.cache_adapter.stats.totals()["counters"], counters)
+
+    def test_uncacheable_method(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.put(self.url + "/stats", data=b"data")
+            self.assertNotIn("miss", session.stats.totals()["counters"])
+
+    def test_timings(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/slow")
+            session.get(self.url + "/slow")
+            timings = session.stats.totals()["timings"]
+        self.assertEqual(timings["network"]["count"], 1)
+        self.assertGreaterEqual(timings["network"]["total"], 200)
+        self.assertEqual(timings["lookup"]["count"], 2)
+        self.assertEqual(sum(timings["lookup"]["buckets"]), 2)
+
+    def test_evict(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/one")
+            session.get(self.url + "/two")
+            session.cache_adapter.evict(1)
+            self.assertEqual(session.cache_adapter.stats.snapshot()["127.0.0.1"]["counters"]["evict"], 2)
+
+    def test_dump(self):
+        path = os.path.join(self.cache_location, "stats.json")
+        stats = urlquick.CacheStats()
+        for _ in range(2):
+            stats.count("example.com", "fresh")
+            stats.timing("example.com", "lookup", 0.003)
+            stats.dump(path)
+
+        with open(path) as stream:
+            saved = json.load(stream)["example.com"]
+        self.assertEqual(saved["counters"]["fresh"], 2)
+        self.assertEqual(saved["timings"]["lookup"]["buckets"][2], 2)
+        self.assertEqual(stats.snapshot(), {})
+
+
+class Compression(LocalServer):
+    def record(self, session, url):
+        urlhash = urlquick.hash_url(urlquick.Request("GET", url).prepare())
+        return session.cache_adapter.execute("SELECT codec, size FROM urlcache WHERE key = ?", (urlhash,)).fetchone()
+
+    def test_compressed(self):
+        url = self.url + "/compress"
+        with urlquick.Session(self.cache_location) as session:
+            body = session.get(url).content
+            record = self.record(session, url)
+            self.assertEqual(record["codec"], urlquick.COMPRESS_CODEC)
+            self.assertLess(record["size"], len(body) // 5)
+
+            session.cache_adapter.memory_cache.clear()
+            resp = session.get(url)
+            self.assertTrue(resp.from_cache)
+            self.assertEqual(resp.content, body)
+
+    def test_uncompressed(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/small")
+            session.get(self.url + "/random")
+            self.assertIsNone(self.record(session, self.url + "/small")["codec"])
+            self.assertIsNone(self.record(session, self.url + "/random")["codec"])
+
+    def test_unknown_codec(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/compress")
+            session.cache_adapter.execute("UPDATE urlcache SET codec = 'unknown'")
+            session.cache_adapter.memory_cache.clear()
+            self.assertFalse(session.get(self.url + "/compress").from_cache)
+        self.assertEqual(RequestHandler.hits, 2)
+
+    @unittest.skipIf(sqlite3.sqlite_version_info < (3, 35), "sqlite does not support dropping columns")
+    def test_upgrade(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/small")
+            session.cache_adapter.execute("ALTER TABLE urlcache DROP COLUMN codec")
+            session.cache_adapter.execute("PRAGMA user_version=10")
+        urlquick.close_session()
+
+        # Entries from before the codec marker was added are kept
+        with urlquick.Session(self.cache_location) as session:
+            session.cache_adapter.memory_cache.clear()
+            self.assertTrue(session.get(self.url + "/small").from_cache)
+            session.get(self.url + "/compress")
+            self.assertEqual(self.record(session, self.url + "/compress")["codec"], urlquick.COMPRESS_CODEC)
+
+
+class StaleIfError(LocalServer):
+    def test_server_error(self):
+        with urlquick.Session(self.cache_location, stale_if_error=60) as session:
+            session.get(self.url + "/flaky")
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            RequestHandler.fail = True
+            resp = session.get(self.url + "/flaky")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.from_cache)
+            self.assertTrue(resp.is_stale)
+            self.assertEqual(session.stats.totals()["counters"]["stale_error"], 1)
+
+    def test_timeout(self):
+        with urlquick.Session(self.cache_location, stale_if_error=60, stale_timeout=0.05) as session:
+            session.get(self.url + "/slow")
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            start = time.time()
+            resp = session.get(self.url + "/slow")
+            self.assertLess(time.time() - start, 0.2)
+            self.assertTrue(resp.is_stale)
+            self.assertEqual(resp.text, "/slow")
+
+    def test_outside_window(self):
+        with urlquick.Session(self.cache_location, stale_if_error=60) as session:
+            session.get(self.url + "/flaky")
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 61)
+            RequestHandler.fail = True
+            self.assertEqual(session.get(self.url + "/flaky").status_code, 503)
+
+    def test_disabled(self):
+        with urlquick.Session(self.cache_location) as session:
+            session.get(self.url + "/flaky")
+            age_cache(session.cache_adapter, urlquick.MAX_AGE + 1)
+            RequestHandler.fail = True
+            self.assertEqual(session.get(self.url + "/flaky").status_code, 503)
+            self.assertEqual(session.get(self.url + "/flaky", stale_if_error=60).status_code, 200)
+
+
+class Sharding(LocalServer):
+    def setUp(self):
+        super(Sharding, self).setUp()
+        self.shards, urlquick.CACHE_SHARDS = urlquick.CACHE_SHARDS, 4
+        self.urls = [self.url + "/page%d" % i for i in range(12)]
+
+    def tearDown(self):
+        urlquick.CACHE_SHARDS = self.shards
+        super(Sharding, self).tearDown()
+
+    @staticmethod
+    def counts(adapter):
+        return [shard.execute("SELECT COUNT(*) FROM urlcache").fetchone()[0] for shard in adapter.shards]
+
+    def test_split(self):
+        with urlquick.Session(self.cache_location) as session:
+            for url in self.urls:
+                session.get(url)
+            session.cache_adapter.memory_cache.clear()
+            self.assertTrue(all(session.get(url).from_cache for url in self.urls))
+            counts = self.counts(session.cache_adapter)
+
+        self.assertEqual(sum(counts), len(self.urls))
+        self.assertGreater(len([count for count in counts if count]), 1)
+        for name in (".urlquick.slite3", ".urlquick.1.slite3", ".urlquick.2.slite3", ".urlquick.3.slite3"):
+            self.assertTrue(os.path.exists(os.path.join(self.cache_location, name)))
+
+    def test_corrupted_shard(self):
+        with urlquick.Session(self.cache_location) as session:
+            for url in self.urls:
+                session.get(url)
+            counts = self.counts(session.cache_adapter)
+        urlquick.close_session()
+        urlquick.get_memory_cache(os.path.join(self.cache_location, ".urlquick.slite3")).clear()
+
+        # Keys depend on the server port, so corrupt whichever shard after the first has items
+        index = next(index for index, count in enumerate(counts) if count and index)
+        with open(os.path.join(self.cache_location, ".urlquick.%d.slite3" % index), "wb") as stream:
+            stream.write(b"not a database" * 100)
+
+        with urlquick.Session(self.cache_location) as session:
+            cached = [session.get(url).from_cache for url in self.urls]
+        self.assertEqual(sum(cached), len(self.urls) - counts[index])
+
+    def test_evict(self):
+        with urlquick.Session(self.cache_location) as session:
+            for url in self.urls:
+                session.get(url)
+            adapter = session.cache_adapter
+            adapter.execute("UPDATE urlcache SET last_access = 0")
+            self.assertEqual(adapter.evict(1), len(self.urls))
+            self.assertEqual(self.counts(adapter), [0, 0, 0, 0])
+
+    def test_evict_oldest_across_shards(self):
+        with urlquick.Session(self.cache_location) as session:
+            adapter = session.cache_adapter
+            keys = []
+            for index, url in enumerate(self.urls):
+                keys.append(session.get(url).urlhash)
+                adapter.database(keys[-1]).execute("UPDATE urlcache SET last_access = ? WHERE key = ?",
+                                                   (index, keys[-1]))
+
+            sizes = [adapter.database(key).execute("SELECT size FROM urlcache WHERE key = ?", (key,)).fetchone()[0]
+                     for key in keys]
+            # Evict down to 90% of the limit, which leaves the six most recently used items
+            self.assertEqual(adapter.evict(int(sum(sizes[6:]) / 0.9) + 1), 6)
+            remaining = [key for key in keys
+                         if adapter.database(key).execute("SELECT 1 FROM urlcache WHERE key = ?", (key,)).fetchone()]
+            self.assertEqual(remaining, keys[6:])
+
+
+class PersistentCookies(LocalServer):
+    def get(self, path, persist_cookies=True):
+        with urlquick.Session(self.cache_location, max_age=-1, persist_cookies=persist_cookies) as session:
+            return sorted(session.get(self.url + path).text.split("; "))
+
+    def test_restored(self):
+        self.get("/login")
+        self.assertEqual(self.get("/whoami"), ["consent=yes", "token=secret"])
+
+    def test_new_location(self):
+        # A fresh add-on profile, where the directory does not exist yet
+        self.addCleanup(shutil.rmtree, self.cache_location, True)
+        self.cache_location = os.path.join(self.cache_location, "profile")
+        self.get("/login")
+        self.assertEqual(self.get("/whoami"), ["consent=yes", "token=secret"])
+
+    def test_disabled(self):
+        self.get("/login", persist_cookies=False)
+        self.assertEqual(self.get("/whoami"), [""])
+
+    def test_removed(self):
+        self.get("/login")
+        self.get("/logout")
+        self.assertEqual(self.get("/whoami"), ["consent=yes"])
+
+    def test_expired(self):
+        self.get("/login")
+        conn = sqlite3.connect(os.path.join(self.cache_location, ".urlquick.cookies.slite3"))
+        with conn:
+            conn.execute("UPDATE cookies SET expires = 1 WHERE name = 'token'")
+            conn.execute("UPDATE cookies SET created = 0 WHERE expires IS NULL")
+        conn.close()
+        self.assertEqual(self.get("/whoami"), [""])
+
+    def test_merged(self):
+        # Jars only write their own changes, so concurrent processes don't undo each other
+        filename = os.path.join(self.cache_location, "cookies.slite3")
+        first = urlquick.PersistentCookieJar(filename)
+        second = urlquick.PersistentCookieJar(filename)
+        first.set("first", "1", domain="example.com", path="/")
+        second.set("second", "2", domain="example.com", path="/")
+        first.save()
+        second.save()
+        self.assertEqual(sorted(urlquick.PersistentCookieJar(filename).keys()), ["first", "second"])
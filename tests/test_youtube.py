@@ -121,6 +121,32 @@ class TestAPIControl(unittest.TestCase):
         self.assertEqual(ret, 4302)
 
 
+class TestAPI(unittest.TestCase):
+    def setUp(self):
+        self.api = youtube.API()
+
+        class Session(object):
+            calls = []
+            response = {u"items": []}
+
+            def get_json(self, url, params=None):
+                self.calls.append((url, dict(params)))
+                return self.response
+
+        self.api.req_session = Session()
+
+    def test_request_get_json(self):
+        ret = self.api._request("https://www.googleapis.com/youtube/v3/videos", {"id": "-QEXPO9zgX8"})
+        self.assertIs(ret, self.api.req_session.response)
+        self.assertListEqual(self.api.req_session.calls,
+                             [("https://www.googleapis.com/youtube/v3/videos", {"id": "-QEXPO9zgX8"})])
+
+    def test_request_error(self):
+        self.api.req_session.response = {u"error": {u"errors": [{u"message": u"quota exceeded"}]}}
+        with self.assertRaises(RuntimeError):
+            self.api._request("https://www.googleapis.com/youtube/v3/videos", {"id": "-QEXPO9zgX8"})
+
+
 class TestDB(unittest.TestCase):
     def setUp(self):
         self.db = youtube.Database()